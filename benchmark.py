@@ -0,0 +1,206 @@
+import sys
+import subprocess
+import numpy as np
+from time import perf_counter
+
+from energy_harvest import EnergyHarvester
+from data_utils import *
+from data_utils import _run_policy
+from fleet_sim import FleetSimulator
+
+# ====================== settings of the demo ======================
+body_parts = ['torso','right_arm','left_arm','right_leg','left_leg']
+
+eh_params = {
+	'proof_mass': 1*(10**-3),
+	'spring_const': 0.17,
+	'spring_damp': 0.0055,
+	'disp_max': 0.01,
+	'efficiency':0.3
+}
+
+
+def load_stream(name='val', fs=25, dtype=np.float64):
+	""" Loads a bundled stream as a (3K+1) x T data window (time in column 0) """
+	label_stream = np.load(f'data_streams/{name}_labels.npy')
+	data_stream = np.load(f'data_streams/{name}_data.npy')
+	time_ax = np.arange(len(label_stream))/fs
+	full_data_window = np.concatenate([np.expand_dims(time_ax,axis=0),data_stream],axis=0).T
+	return full_data_window.astype(dtype, copy=False), label_stream
+
+
+# ====================== reports ======================
+def compare_dtypes(data_window, body_parts, packet_size=16, leakage=6e-6, policy='opportunistic', dtype=np.float32, fs=25):
+	""" Runs sparsify_data in float64 and in a reduced precision dtype and reports how far the
+		packet decisions drift apart
+
+	Returns
+	-------
+
+	report: dict
+		per body part: number of packets in each run, number of packets sent at the same
+		sample in both runs, fraction of valid samples that agree, max abs e_plot difference (J),
+		and the run times in seconds
+	"""
+	runs = {}
+	for dt in [np.float64, dtype]:
+		eh = EnergyHarvester(**eh_params, dtype=dt)
+		start = perf_counter()
+		packets, e_plots, thresh = sparsify_data(data_window.astype(dt), body_parts, packet_size, leakage, eh, policy, visualize=True)
+		runs[np.dtype(dt).name] = (packets, e_plots, perf_counter()-start)
+
+	(ref_packets, ref_e, ref_time), (packets, e_plots, run_time) = runs.values()
+	report = {}
+	for bp in body_parts:
+		# packets are identified by the sample they arrive at
+		ref_idx = np.round(np.asarray(ref.packets[bp][0], dtype=np.float64)*fs).astype(int)
+		idx = np.round(np.asarray(packets[bp][0], dtype=np.float64)*fs).astype(int)
+		ref_valid = np.zeros(len(ref_e[bp]), dtype=bool)
+		valid = np.zeros(len(e_plots[bp]), dtype=bool)
+		for i in ref_idx:
+			ref_valid[i-packet_size:i] = True
+		for i in idx:
+			valid[i-packet_size:i] = True
+
+		report[bp] = {
+			'packets_float64': len(ref_idx),
+			'packets_'+np.dtype(dtype).name: len(idx),
+			'same_packets': len(np.intersect1d(ref_idx, idx)),
+			'valid_agreement': np.mean(ref_valid == valid),
+			'max_e_diff': np.max(np.abs(ref_e[bp] - e_plots[bp].astype(np.float64))),
+		}
+	report['time_float64'] = ref_time
+	report['time_'+np.dtype(dtype).name] = run_time
+	return report
+
+
+def compare_engines(data_window, body_parts, packet_size=16, leakage=6e-6, policy='opportunistic'):
+	""" Accuracy of the 'fft' harvester engine against the 'lsim' reference and the throughput
+		of EnergyHarvester.power() with each engine
+
+	Returns
+	-------
+
+	report: dict
+		per body part: max abs power difference relative to the peak power, relative difference
+		of the total energy and whether sparsify_data sends the same packets. Then the samples
+		per second of power() for each engine
+	"""
+	import pandas as pd
+
+	engines = {engine: EnergyHarvester(**eh_params, engine=engine) for engine in ['lsim','fft']}
+	packets = {engine: sparsify_data(data_window, body_parts, packet_size, leakage, eh, policy) for engine, eh in engines.items()}
+	elapsed = {engine: 0.0 for engine in engines}
+
+	report = {}
+	for i, bp in enumerate(body_parts):
+		df = pd.DataFrame(data_window[:,[0,3*i+1,3*i+2,3*i+3]],columns=['time', 'x', 'y','z'])
+		power = {}
+		for engine, eh in engines.items():
+			start = perf_counter()
+			time, power[engine] = eh.power(df)
+			elapsed[engine] += perf_counter()-start
+		energy = {engine: eh.energy(time, power[engine])[-1] for engine, eh in engines.items()}
+		report[bp] = {
+			'max_power_error': np.max(np.abs(power['fft']-power['lsim']))/np.max(power['lsim']),
+			'energy_error': abs(energy['fft']-energy['lsim'])/energy['lsim'],
+			'same_packets': np.array_equal(packets['fft'][bp][0], packets['lsim'][bp][0])
+		}
+	for engine in engines:
+		report[f'{engine}_samples_per_second'] = len(data_window)*len(body_parts)/elapsed[engine]
+	return report
+
+
+def compare_chunked(data_window, body_parts, packet_size=16, leakage=6e-6, policy='opportunistic', chunk=25*60*10, fs=25):
+	""" Whether the chunked sparsify gives the packets of sparsify_data on the same stream and
+		how close the harvested energy is (it should only differ by rounding)
+
+	Returns
+	-------
+
+	report: dict
+		per body part: number of packets in each run, whether the packets are the same, the
+		largest difference of the arrival times in samples and the relative difference of the
+		harvested energy
+	"""
+	eh = EnergyHarvester(**eh_params)
+	ref = sparsify_data(data_window, body_parts, packet_size, leakage, eh, policy, return_accounting=True)
+	packets = {bp: [] for bp in body_parts}
+	state = None
+	for start in range(0, len(data_window), chunk):
+		chunk_packets, state = sparsify(data_window[start:start+chunk], body_parts, packet_size, leakage, eh, policy, state,
+										final=start+chunk >= len(data_window))
+		for bp in body_parts:
+			packets[bp].append(np.asarray(chunk_packets[bp][0], dtype=np.float64).reshape(-1))
+
+	report = {}
+	for bp in body_parts:
+		ref_idx = np.round(np.asarray(ref.packets[bp][0], dtype=np.float64).reshape(-1)*fs).astype(int)
+		idx = np.round(np.concatenate(packets[bp])*fs).astype(int)
+		harvested = state[bp].accounting()['harvested']
+		report[bp] = {
+			'packets_sparsify_data': len(ref_idx),
+			'packets_sparsify': len(idx),
+			'same_packets': np.array_equal(idx, ref_idx),
+			'max_offset_samples': np.max(np.abs(idx-ref_idx), initial=0) if len(idx) == len(ref_idx) else np.nan,
+			'energy_error': abs(harvested-ref.accounting[bp]['harvested'])/ref.accounting[bp]['harvested'],
+		}
+	return report
+
+
+def fleet_throughput(data_window, body_parts, fleet_sizes=(10,100,1000), packet_size=16, leakage=6e-6, policy='opportunistic'):
+	""" Samples simulated per second by FleetSimulator for growing fleets (the body parts of the
+		stream are repeated to reach each fleet size) next to the per device policy loop """
+	eh = EnergyHarvester(**eh_params)
+	fleet = FleetSimulator.from_data_windows([data_window], body_parts, packet_size, leakage, eh, policy)
+
+	start = perf_counter()
+	for e_out in fleet.e_out:
+		_run_policy(e_out, fleet.thresh, packet_size, fleet.LEAKAGE_PER_SAMPLE, policy)
+	report = {'per_device_loop': fleet.e_out.size/(perf_counter()-start)}
+	for D in fleet_sizes:
+		e_out = np.resize(fleet.e_out, (D, fleet.T))
+		start = perf_counter()
+		FleetSimulator(e_out, fleet.thresh, packet_size, leakage, policy, fleet.fs).run()
+		report[f'fleet_{D}'] = e_out.size/(perf_counter()-start)
+	return report
+
+
+def import_times(modules=('energy_harvest','data_utils','fleet_sim'), budget=0.25, repeat=5):
+	""" Time to import each core module in a fresh interpreter (best of repeat runs) next to
+		plain numpy, and whether it is within the budget in seconds. The core modules should
+		only load numpy, the heavy modules that got imported anyway are listed """
+	code = ("import sys, time; t = time.perf_counter(); import {}; t = time.perf_counter()-t; "
+			"print(t, *[m for m in ('scipy','pandas') if m in sys.modules])")
+	report = {}
+	for module in ('numpy',)+tuple(modules):
+		runs = [subprocess.run([sys.executable, '-c', code.format(module)], capture_output=True, text=True, check=True).stdout.split() for _ in range(repeat)]
+		seconds = min(float(run[0]) for run in runs)
+		report[module] = {'seconds': seconds, 'within_budget': seconds <= budget, 'heavy_imports': runs[0][1:]}
+	return report
+
+
+def print_report(title, report):
+	print(f"====================== {title} ======================")
+	for k, v in report.items():
+		print(k, v)
+
+
+if __name__ == '__main__':
+	print_report("import time", import_times())
+
+	full_data_window, label_stream = load_stream(sys.argv[1] if len(sys.argv) > 1 else 'val')
+
+	for policy in ['opportunistic','conservative_1.2','dense']:
+		print_report(f"float32 vs float64 ({policy})", compare_dtypes(full_data_window, body_parts, policy=policy))
+
+	print_report("fft vs lsim harvester engine", compare_engines(full_data_window, body_parts))
+
+	print_report("chunked sparsify vs sparsify_data", compare_chunked(full_data_window, body_parts))
+
+	print_report("fleet samples per second", fleet_throughput(full_data_window, body_parts))
+
+	eh = EnergyHarvester(**eh_params)
+	result = sparsify_data(full_data_window, body_parts, 16, 6e-6, eh, return_valid=True, return_trace=True)
+	print("====================== per activity ======================")
+	print(activity_report(label_stream, result.valid, traces=result.traces).to_string())
@@ -1,6 +1,9 @@
-import pandas as pd
 import numpy as np
 from enum import Enum
+import copy
+import operator
+from itertools import chain
+from collections import OrderedDict, namedtuple
 
 class DeviceState(Enum):
 	OFF = 0
@@ -8,11 +11,197 @@ class DeviceState(Enum):
 	ON_CANT_TX = 2 
 
 INIT_OVERHEAD = 150*1e-6 # 120 uJ
+POLICY_BLOCK = 65536 # samples of e_out converted to python floats at a time by _run_policy
+
+class PolicyState():
+	""" Everything the simulation of one device needs to continue a stream where the last
+		chunk ended: the device state, the energy spent so far, the conservative policy EMA,
+		a packet still in flight and (for sparsify) the harvester state and the last samples
+		of data. It also keeps the energy accounting counters of the device, see accounting().
+		Plain attributes so it can be pickled, to_dict() gives a json friendly version """
+
+	def __init__(self,device_state=DeviceState.OFF,e_target=np.nan,st=np.nan,en=np.nan,iat_mu=np.nan,wt=np.nan,
+				 debit=0.0,e_prev=0.0,packet_start=-1,k=0,harvester=None,tail=None,
+				 restarts=0,brownouts=0,n_packets=0,e_packets=0.0,e_clipped=0.0,e_harvested=0.0,e_stored=0.0,
+				 state_samples=None,state_since=0):
+		self.device_state = DeviceState(device_state)
+		self.e_target = e_target
+		self.st = st # index of the second to last packet
+		self.en = en # index of the last packet
+		self.iat_mu = iat_mu # running mean of the inter arrival time
+		self.wt = wt # wait since the last packet
+		self.debit = debit # energy spent since the start of the stream
+		self.e_prev = e_prev # stored energy at the last sample
+		self.packet_start = packet_start # first sample of the packet in flight, -1 if none
+		self.k = k # number of samples processed
+		self.harvester = harvester # HarvesterState
+		self.tail = tail # last packet_size+1 rows (time, x, y, z) for packets spanning chunks
+
+		# energy accounting, only updated on events (state changes and packets)
+		self.restarts = restarts # OFF -> ON transitions, each pays INIT_OVERHEAD
+		self.brownouts = brownouts # ON -> OFF transitions (device died)
+		self.n_packets = n_packets # packets completed
+		self.e_packets = e_packets # energy spent on packets
+		self.e_clipped = e_clipped # energy the dense policy dropped above MAX_E
+		self.e_harvested = e_harvested # cumulative harvested energy at the last sample
+		self.e_stored = e_stored # stored energy at the last sample
+		self.state_samples = [0,0,0] if state_samples is None else list(state_samples) # per DeviceState value, closed runs only
+		self.state_since = state_since # sample the current device state started at
+
+	def copy(self):
+		return copy.deepcopy(self)
+
+	def to_dict(self) -> dict:
+		return {
+			'device_state': self.device_state.value,
+			'e_target': float(self.e_target),
+			'st': float(self.st),
+			'en': float(self.en),
+			'iat_mu': float(self.iat_mu),
+			'wt': float(self.wt),
+			'debit': float(self.debit),
+			'e_prev': float(self.e_prev),
+			'packet_start': int(self.packet_start),
+			'k': int(self.k),
+			'harvester': None if self.harvester is None else self.harvester.to_dict(),
+			'tail': None if self.tail is None else self.tail.tolist(),
+			'restarts': int(self.restarts),
+			'brownouts': int(self.brownouts),
+			'n_packets': int(self.n_packets),
+			'e_packets': float(self.e_packets),
+			'e_clipped': float(self.e_clipped),
+			'e_harvested': float(self.e_harvested),
+			'e_stored': float(self.e_stored),
+			'state_samples': [int(n) for n in self.state_samples],
+			'state_since': int(self.state_since)
+		}
+
+	def accounting(self) -> dict:
+		""" Where the harvested energy of the device went, from the counters kept by _run_policy
+
+		Energies are in J and add up: harvested = stored + overhead + packets + leakage + clipped.
+		Clipped is the harvested energy above MAX_E that is not stored (and the surplus the dense
+		policy drops), net of overdraft clipped at 0. A packet still in flight is not counted yet.
+		Time in each DeviceState is in samples.
+		"""
+		e_overhead = self.restarts*INIT_OVERHEAD
+		state_samples = list(self.state_samples)
+		state_samples[self.device_state.value] += self.k - self.state_since
+		return {
+			'harvested': self.e_harvested,
+			'stored': self.e_stored,
+			'overhead': e_overhead,
+			'packets': self.e_packets,
+			# every other debit is leakage
+			'leakage': self.debit - e_overhead - self.e_packets - self.e_clipped,
+			'clipped': (self.e_harvested - self.debit - self.e_stored) + self.e_clipped,
+			'n_packets': self.n_packets,
+			'restarts': self.restarts,
+			'brownouts': self.brownouts,
+			**{'samples_'+s.name.lower(): state_samples[s.value] for s in DeviceState}
+		}
+
+	@staticmethod
+	def from_dict(d: dict):
+		from energy_harvest import HarvesterState
+
+		d = dict(d)
+		if d.get('harvester') is not None:
+			d['harvester'] = HarvesterState.from_dict(d['harvester'])
+		if d.get('tail') is not None:
+			d['tail'] = np.array(d['tail'])
+		return PolicyState(**d)
+
+# kinds of segments in the event log of _run_policy, see EnergyTrace
+LEAK = 0 # not sampling, energy above 0 so it leaks every sample
+HOLD = 1 # not sampling, no energy left to leak
+PACKET = 2 # sampling a packet, linear usage over the packet
+EVENT_DTYPE = np.dtype([('k','i8'),('debit','f8'),('kind','i1'),('correction','f8')])
+
+class EnergyTrace():
+	""" The energy stored on a device (e_plot of _run_policy) reconstructed on demand from the
+		cumulative harvested energy and the compact event log of the policy, so the dense trace
+		never has to be kept around. The log has one entry per segment of samples that the
+		debit evolves linearly over (a packet, a run of leaking samples, a run without energy),
+		so a window is rebuilt with a few vectorized operations. Recently viewed windows are
+		cached. Index it like the e_plot array, e.g. trace[start:end] """
+
+	def __init__(self,e_out,log: np.ndarray,thresh: float,packet_size: int,LEAKAGE_PER_SAMPLE: float,policy: str,dtype=np.float64,cache_size=16):
+		self.e_out = e_out # any array like, e.g. np.memmap, only the viewed windows are read
+		self.log = log
+		self.thresh = float(thresh)
+		self.packet_size = packet_size
+		self.LEAKAGE_PER_SAMPLE = LEAKAGE_PER_SAMPLE
+		self.policy = policy
+		self.dtype = np.dtype(dtype)
+		self.MAX_E = INIT_OVERHEAD + self.thresh
+		self.cache_size = cache_size
+		self._cache = OrderedDict()
+
+		# same usage during a packet as _run_policy
+		self.linear_usage = np.linspace(0,self.thresh,packet_size+1)
+		self.linear_leakage = np.linspace(0,LEAKAGE_PER_SAMPLE*packet_size,packet_size+1)
+		if policy == 'dense':
+			self.linear_usage[:] = 0
+
+	def __getstate__(self):
+		# the cache is not worth pickling
+		d = self.__dict__.copy()
+		d['_cache'] = OrderedDict()
+		return d
+
+	def __len__(self):
+		return len(self.e_out)
+
+	def __getitem__(self, idx):
+		if isinstance(idx, slice):
+			start, end, step = idx.indices(len(self))
+			return self.window(start, end)[::step]
+		k = operator.index(idx)
+		k = k + len(self) if k < 0 else k
+		if not 0 <= k < len(self):
+			raise IndexError(f"index {idx} is out of bounds for a trace of length {len(self)}")
+		return self.window(k, k+1)[0]
+
+	def window(self,start: int,end: int) -> np.ndarray:
+		""" energy stored at samples [start, end), a read only array """
+		start, end = max(start,0), min(end,len(self))
+		key = (start, end)
+		if key in self._cache:
+			self._cache.move_to_end(key)
+			return self._cache[key]
+
+		L = self.LEAKAGE_PER_SAMPLE
+		k = np.arange(start, max(start,end))
+		seg = np.searchsorted(self.log['k'], k, side='right') - 1
+		n = k - self.log['k'][seg]
+		kind = self.log['kind'][seg]
+		raw = np.asarray(self.e_out[start:end], dtype=np.float64)
+
+		leak = kind == LEAK
+		debit = self.log['debit'][seg] + np.where(leak, n*L, 0.0)
+		e = np.clip(raw - debit, 0, self.MAX_E)
+		e = np.where(leak, np.clip(e - L, 0, self.MAX_E), e)
+		sampling = (kind == PACKET) & (n > 0)
+		j = np.minimum(n, self.packet_size)
+		e_packet = raw - debit - self.linear_usage[j] - self.linear_leakage[j]
+		e_packet -= np.where(j == self.packet_size, self.log['correction'][seg], 0.0)
+		e = np.where(sampling, e_packet, e).astype(self.dtype, copy=False)
+		e.flags.writeable = False
+
+		self._cache[key] = e
+		if len(self._cache) > self.cache_size:
+			self._cache.popitem(last=False)
+		return e
 
 # ============ helper functions ============
 
+# what sparsify_data returns when any output beyond the packets and the visualize triple is
+# requested, the outputs that were not requested are None
+SparsifyResult = namedtuple('SparsifyResult', ['packets','e_plots','thresh','valid','accounting','traces','features'])
+
 # TODO: implement this function in a more general way to be flexible to the energy spending policy
-def sparsify_data(data_window: np.ndarray,body_parts: list,packet_size: int,leakage: float,eh,policy='opportunistic',visualize=False):
+def sparsify_data(data_window: np.ndarray,body_parts: list,packet_size: int,leakage: float,eh,policy='opportunistic',visualize=False,dtype=None,return_valid=False,fs=None,return_accounting=False,return_trace=False,features=None):
 	""" Converts a 3 axis har signal into a sparse version based on energy harvested. This
 		is based on an opportunistic policy (transmit when hit the threshold)
 
@@ -24,6 +213,7 @@ def sparsify_data(data_window: np.ndarray,body_parts: list,packet_size: int,leak
 		The extra column (at column 0) is the time in seconds for each sample. The data from
 		Each body part is assumed to be aligned in time.
 		Example columns: time | armX | armY | armZ | legX | legY | legZ | ...
+		If fs is given there is no time column and the data array is 3K x T.
 
 	body_parts: list
 		A list of strings specifying the body parts, e.g., ["arm", "leg", ...]
@@ -42,360 +232,1214 @@ def sparsify_data(data_window: np.ndarray,body_parts: list,packet_size: int,leak
 	visualize: bool
 		A flag to return an array of energy values for plotting
 
+	dtype: np.dtype
+		floating point type of the data window, packets and e_plots (e.g. np.float32).
+		Defaults to eh.dtype. Only these outputs are stored in dtype, the harvester
+		computes the power and the cumulative energy in float64 and the policy tracks
+		the stored energy level in float64, so packet decisions stay close to the
+		float64 run
+
+	return_valid: bool
+		A flag to also return the sampled intervals of each body part (see below)
+
+	fs: float
+		sampling rate in Hz of uniformly sampled data. The harvester and policy then use
+		the scalar sample spacing instead of a time column and arrival times are computed
+		from the sample index of each packet (seconds since the first sample)
+
+	return_accounting: bool
+		A flag to also return the energy accounting of each body part (see below)
+
+	return_trace: bool
+		A flag to also return the stored energy of each body part as an EnergyTrace, which
+		rebuilds any window of e_plots on demand from a compact event log
+
+	features: tuple
+		names of per packet features to also return (e.g. PACKET_FEATURES), computed for
+		all body parts at once by packet_features()
+
 	Returns
 	-------
 
-	sparse_data: tuple
-		TODO
+	packets: dict
+		per body part a tuple (arrival_times, packet_data), arrival_times is P x 1 and
+		packet_data is P x packet_size x 3. A packet cut off by the end of the data is dropped.
+		With visualize the tuple (packets, e_plots, thresh) is returned instead, and if any of
+		return_valid, return_accounting, return_trace or features is given a SparsifyResult
+		with the fields below (None if not requested), e.g. sparsify_data(..., return_valid=True).valid
+
+	e_plots: dict
+		only if visualize, per body part the energy stored on the device at each sample
+
+	thresh: float
+		the energy needed per packet (only returned with visualize or in a SparsifyResult)
+
+	valid: dict
+		only if return_valid, per body part an N x 2 array of [start, end) sample intervals
+		where data was sampled, see intervals_to_mask() and mask_data() to expand it
+
+	accounting: dict
+		only if return_accounting, per body part a dict of where the harvested energy went
+		and the samples spent in each DeviceState, see PolicyState.accounting()
+
+	traces: dict
+		only if return_trace, per body part an EnergyTrace, trace[start:end] is the same as
+		e_plots[bp][start:end] (up to rounding)
+
+	features: dict
+		only if features, per body part a P x F feature matrix with the columns of
+		feature_names(features), row p belongs to packet p
 	"""
 
-	LEAKAGE_PER_SAMPLE = leakage*(data_window[1,0]-data_window[0,0]) # 1uW * 1/fs
+	dtype = eh.dtype if dtype is None else np.dtype(dtype)
+	data_window = np.asarray(data_window, dtype=dtype)
+
+	if fs is None:
+		LEAKAGE_PER_SAMPLE = leakage*float(data_window[1,0]-data_window[0,0]) # 1uW * 1/fs
+	else:
+		LEAKAGE_PER_SAMPLE = leakage*(1/fs)
 	# print(LEAKAGE_PER_SAMPLE)
 
 	# each body part is processed separately (every three channels)
-	j = 1 # index of X channel for a body part
+	j = 1 if fs is None else 0 # index of X channel for a body part
 	packets = {bp: None for bp in body_parts}
 	e_plots = {bp: None for bp in body_parts}
-
+	valid_intervals = {bp: None for bp in body_parts}
+	accounting = {bp: None for bp in body_parts}
+	traces = {bp: None for bp in body_parts}
 
 	for i,bp in enumerate(body_parts):
-		# create pandas data frame as specified by EnergyHarvester.power() function
-		channels = np.array([0,j,j+1,j+2]) # time + 3 acc channels of body part
-		df = pd.DataFrame(data_window[:,channels],columns=['time', 'x', 'y','z'])
+		if fs is None:
+			# create pandas data frame as specified by EnergyHarvester.power() function
+			import pandas as pd
+			channels = np.array([0,j,j+1,j+2]) # time + 3 acc channels of body part
+			data = pd.DataFrame(data_window[:,channels],columns=['time', 'x', 'y','z'])
+		else:
+			# no time column, the 3 acc channels go straight to the harvester
+			channels = np.array([-1,j,j+1,j+2])
+			data = data_window[:,channels[1:]]
 		j += 3 # increment to next body part
 		
 		# get energy as function of samples
-		t_out, p_out = eh.power(df)
-		e_out = eh.energy(t_out, p_out)
-		valid, thresh = eh.generate_valid_mask(e_out, packet_size)
-
-		# assume max energy we can store is 3*thresh needed to sample/TX
-		MAX_E = INIT_OVERHEAD + thresh
-		# print(MAX_E)
-
-		# now we need to generate a valid mask
-		valid = np.empty(len(e_out))
-		valid[:] = np.nan
+		t_out, p_out = eh.power(data, fs=fs)
+		e_out = eh.energy(t_out, p_out, fs=fs)
+		thresh = eh._energy_per_packet(packet_size)
 
-		# generate e_plot
-		e_target = thresh.copy()
-		e_plot = e_out.copy()
+		intervals, e_plot, log, s = _run_policy(e_out, thresh, packet_size, LEAKAGE_PER_SAMPLE, policy, dtype, plot=visualize == True)
 
-		if 'conservative' in policy:
-			fraction = float(policy.split('_')[1])
-		else:
-			fraction = 1
-
-		charge_up_thresh = fraction*thresh # conservative threshold for charging up
-		if 'conservative' in policy:
-			e_target = charge_up_thresh.copy()
-
-		STATE = DeviceState.OFF
-
-		# assume a linear energy usage over the course of a packet
-		# i.e., thresh/packet_size used per sample. The array is
-		# of size packet_size+1 because it starts at 0, then increments
-		# by thresh/packet_size for each sample
-		linear_usage = np.linspace(0,thresh,packet_size+1)
-		linear_leakage = np.linspace(0,LEAKAGE_PER_SAMPLE*packet_size,packet_size+1)
-		k=0
-		st = np.nan
-		en = np.nan
-		iat_mu = np.nan
-		wt = np.nan
-		alpha = 0.65
-
-		# iterate over energy values (need to change this code for other policies)
-		while k < len(e_plot):
-			# house keeping, make sure energy is clipped to bounds
-			if e_plot[k] > MAX_E:
-				e_plot[k] = MAX_E
-			elif e_plot[k] < 0:
-				e_plot[k] = 0
-
-			''' ---------- Opportunistic Policy'''
-			if policy == 'opportunistic':
-				# print(k,k/25,STATE,e_plot[k])
-				# update state
-				if STATE == DeviceState.OFF: # turn on when have init overhead
-					if e_plot[k] >= 5*LEAKAGE_PER_SAMPLE + INIT_OVERHEAD:
-						STATE = DeviceState.ON_CANT_TX
-						e_plot[k+1:] -= INIT_OVERHEAD # apply overhead instantly
-				elif STATE == DeviceState.ON_CAN_TX:
-					if e_plot[k] == 0: # device died
-						STATE = DeviceState.OFF
-					elif e_plot[k] < thresh:#+LEAKAGE_PER_SAMPLE*packet_size:
-						STATE = DeviceState.ON_CANT_TX
-				elif STATE == DeviceState.ON_CANT_TX:
-					if e_plot[k] >= thresh:#+LEAKAGE_PER_SAMPLE*packet_size:
-						STATE = DeviceState.ON_CAN_TX
-					elif e_plot[k] == 0:
-						STATE = DeviceState.OFF
-				
-				# we hit the transmit threshold
-				if STATE == DeviceState.ON_CAN_TX:#(e_plot[k] > e_target):
-					# we are within one packet of the end of the data
-					if k + packet_size + 1 >= len(e_plot):
-						valid[k:] = 1
-						e_plot[k:] -= linear_usage[:len(e_plot)-k]
-						e_plot[k:] -= linear_leakage[:len(e_plot)-k]
-						k += (packet_size+1)
-						break
-					# from the index where the threshold was reached until the packet
-					# has been sampled is length packet_size+1
-					valid[k:k+packet_size] = 1
-					e_plot[k:k+packet_size+1] -= linear_usage[:]
-					e_plot[k:k+packet_size+1] -= linear_leakage[:]
-
-					if e_plot[k+packet_size+1] > 0:
-						# since e_plot is cumulative, subtract thresh from rest of it
-						e_plot[k+packet_size+1:] -= thresh
-
-					if e_plot[k+packet_size+1] > 0:
-						# since e_plot is cumulative, subtract thresh from rest of it
-						e_plot[k+packet_size+1:] -= LEAKAGE_PER_SAMPLE
-
-					k += (packet_size+1)
+		''' ----------- Package Data after applying policies -------- '''
 
-				else:
-					# print(f"{k},{k/25}")
-					# print(e_plot[k:k+2])
-					# apply leakage
-					if e_plot[k] > 0:
-						e_plot[k:] -= LEAKAGE_PER_SAMPLE
-					# print(e_plot[k:k+2])
-					# clip at min and max value
-					if e_plot[k] > MAX_E:
-						e_plot[k] = MAX_E
-					elif e_plot[k] < 0:
-						e_plot[k] = 0
-					# print(e_plot[k:k+2])
-					# print("===")
-					# go to next samples
-					k += 1
-
-
-			elif 'conservative' in policy:
-				# if bp == 'left_leg':
-				#     print(k,k/25,STATE,e_plot[k]-LEAKAGE_PER_SAMPLE-e_plot[k-1],thresh,e_target)
-				if e_target > MAX_E:
-					e_target = MAX_E
-				# update state
-				if STATE == DeviceState.OFF: # turn on when have init overhead
-					if e_plot[k] >= 2*LEAKAGE_PER_SAMPLE+INIT_OVERHEAD:#e_target + INIT_OVERHEAD:
-						STATE = DeviceState.ON_CANT_TX
-						e_plot[k+1:] -= INIT_OVERHEAD # apply overhead instantly
-				elif STATE == DeviceState.ON_CAN_TX:
-					if e_plot[k] == 0: # device died
-						STATE = DeviceState.OFF
-					elif e_plot[k] < e_target:#+LEAKAGE_PER_SAMPLE*packet_size:
-						STATE = DeviceState.ON_CANT_TX
-				elif STATE == DeviceState.ON_CANT_TX:
-					if e_plot[k] >= e_target:#+LEAKAGE_PER_SAMPLE*packet_size:
-						STATE = DeviceState.ON_CAN_TX
-					elif e_plot[k] == 0:
-						STATE = DeviceState.OFF
-
-				# update state vars while device is on
-				if STATE != DeviceState.OFF:
-					if en is not np.nan: # increment wait time between last packet and now
-						wt = k - en
-				else:
-					st = np.nan
-					en = np.nan
-					iat_mu = np.nan
-					wt = np.nan
-					e_target = fraction*thresh
-
-
-				if STATE == DeviceState.ON_CAN_TX:#(e_plot[k] > e_target):
-					# update running mean of iat
-					if st is np.nan:
-						st = k
-					elif en is np.nan:
-						en = k
-						iat_mu = en-st
-					else:
-						st = en
-						en = k
-						iat_mu = alpha*(en-st)+(1-alpha)*iat_mu
-						# print(f'{bp} -- time:{k/25}, st: {st}, en: {en}, iat_mu: {iat_mu}, wt: {wt}, energy: {e_plot[k]}')
-
-					# we are within one packet of the end of the data
-					if k + packet_size + 1 >= len(e_plot):
-						valid[k:] = 1
-						e_plot[k:] -= linear_usage[:len(e_plot)-k]
-						e_plot[k:] -= linear_leakage[:len(e_plot)-k]
-						k += (packet_size+1)
-						break
-					# from the index where the threshold was reached until the packet
-					# has been sampled is length packet_size+1
-					valid[k:k+packet_size] = 1
-					e_plot[k:k+packet_size+1] -= linear_usage[:]
-					e_plot[k:k+packet_size+1] -= linear_leakage[:]
-
-					if e_plot[k+packet_size+1] > 0:
-						# since e_plot is cumulative, subtract thresh from rest of it
-						e_plot[k+packet_size+1:] -= thresh
-
-					if e_plot[k+packet_size+1] > 0:
-						# since e_plot is cumulative, subtract thresh from rest of it
-						e_plot[k+packet_size+1:] -= LEAKAGE_PER_SAMPLE
-
-					k += (packet_size+1)
-
-					# new target
-					e_target = e_plot[k]+charge_up_thresh
-					if e_target > MAX_E:
-						e_target = MAX_E
-				
-				elif STATE == DeviceState.ON_CANT_TX:
-					# have enough energy and waited a while
-					if e_plot[k] > thresh and wt is not np.nan and wt > 2*iat_mu:
-						e_target = e_plot[k]-LEAKAGE_PER_SAMPLE # trigger a state change
-						# st = np.nan
-						# en = np.nan
-						# iat_mu = np.nan
-						# wt = np.nan
-						# print(f'{bp} ** time:{k/25}, st: {st}, en: {en}, iat_mu: {iat_mu}, wt: {wt}, energy: {e_plot[k]}, e_target: {e_target}')
-					# have enough energy and about to transition to cant zone
-					elif e_plot[k] > thresh and ((e_plot[k] + 5*((e_plot[k]-LEAKAGE_PER_SAMPLE)-e_plot[k-1])) < thresh):
-						e_target = e_plot[k]-LEAKAGE_PER_SAMPLE # trigger a state change
-					#     st = np.nan
-					#     en = np.nan
-					#     iat_mu = np.nan
-					#     wt = np.nan
-
-					# apply leakage
-					if e_plot[k] > 0:
-						e_plot[k:] -= LEAKAGE_PER_SAMPLE
-					# clip at min and max value
-					if e_plot[k] > MAX_E:
-						e_plot[k] = MAX_E
-					elif e_plot[k] < 0:
-						e_plot[k] = 0
-					# go to next samples
-					k += 1
+		if visualize == True:
+			e_plots[bp] = e_plot
+		valid_intervals[bp] = intervals
+		accounting[bp] = s.accounting()
+		if return_trace == True:
+			traces[bp] = EnergyTrace(e_out, log, thresh, packet_size, LEAKAGE_PER_SAMPLE, policy, dtype)
 
-				else:
-					# apply leakage
-					if e_plot[k] > 0:
-						e_plot[k:] -= LEAKAGE_PER_SAMPLE
-					# clip at min and max value
-					if e_plot[k] > MAX_E:
-						e_plot[k] = MAX_E
-					elif e_plot[k] < 0:
-						e_plot[k] = 0
-					# go to next samples
-					k += 1
-
-			
-			elif policy == 'dense':
-				if STATE == DeviceState.OFF: # turn on when have init overhead
-					if e_plot[k] >= 5*LEAKAGE_PER_SAMPLE + INIT_OVERHEAD:
-						STATE = DeviceState.ON_CANT_TX
-						e_plot[k+1:] -= INIT_OVERHEAD # apply overhead instantly
-				elif STATE == DeviceState.ON_CAN_TX:
-					if e_plot[k] == 0: # device died
-						STATE = DeviceState.OFF
-					elif e_plot[k] < thresh:#+LEAKAGE_PER_SAMPLE*packet_size:
-						STATE = DeviceState.ON_CANT_TX
-				elif STATE == DeviceState.ON_CANT_TX:
-					if e_plot[k] >= thresh:#+LEAKAGE_PER_SAMPLE*packet_size:
-						STATE = DeviceState.ON_CAN_TX
-					elif e_plot[k] == 0:
-						STATE = DeviceState.OFF
-
-				# we hit the transmit threshold
-				if STATE == DeviceState.ON_CAN_TX:#(e_plot[k] > e_target):
-					# we are within one packet of the end of the data
-					if k + packet_size + 1 >= len(e_plot):
-						valid[k:] = 1
-						# e_plot[k:] = min(MAX_E,e_plot[k])
-						e_plot[k:] -= linear_leakage[:len(e_plot)-k]
-						k += (packet_size+1)
-						break
-					# from the index where the threshold was reached until the packet
-					# has been sampled is length packet_size+1
-					valid[k:k+packet_size] = 1
-					# e_plot[k:k+packet_size+1] -= linear_usage[:]
-					e_plot[k:k+packet_size+1] -= linear_leakage[:]
-
-					surp = (e_plot[k+packet_size+1] - MAX_E)
-
-
-					if surp > 0:
-						e_plot[k+packet_size:] -= 2*surp
-
-
-					# if e_plot[k+packet_size+1] > 0:
-					#     # since e_plot is cumulative, subtract thresh from rest of it
-					#     e_plot[k+packet_size+1:] -= thresh
-					# e_plot[k:] = min(MAX_E,e_plot[k])
-					
-					if e_plot[k+packet_size+1] > 0:
-						# since e_plot is cumulative, subtract thresh from rest of it
-						e_plot[k+packet_size+1:] -= LEAKAGE_PER_SAMPLE*packet_size
-
-
-					k += (packet_size+1)
+		# a packet is every interval except one cut off by the end of the data
+		full = intervals[intervals[:,1] < len(data_window)]
+		packet_start_idxs = full[:,0]
+		packet_end_idxs = full[:,1]
 
-				else:
-					# print(f"{k},{k/25}")
-					# print(e_plot[k:k+2])
-					# apply leakage
-					if e_plot[k] > 0:
-						e_plot[k:] -= LEAKAGE_PER_SAMPLE
-					# print(e_plot[k:k+2])
-					# clip at min and max value
-					if e_plot[k] > MAX_E:
-						e_plot[k] = MAX_E
-					elif e_plot[k] < 0:
-						e_plot[k] = 0
-					# print(e_plot[k:k+2])
-					# print("===")
-					# go to next samples
-					k += 1
-			
-		''' ----------- Package Data after applying policies -------- '''
+		# gather the actually sampled data, P x packet_size x 3
+		sample_idxs = packet_start_idxs[:,None] + np.arange(packet_size)
+		packet_data = data_window[sample_idxs[:,:,None],channels[1:]]
 
-		e_plots[bp] = e_plot
-		# masking the data based on energy (this is where we have differentiability issues)
-		for acc in 'xyz':
-			df[acc+'_eh'] = df[acc] * valid
-
-		# get the transition points of the masked data to see where packets start and end
-		og_data = df[acc+'_eh'].values
-		rolled_data = np.roll(og_data, 1)
-		rolled_data[0] = np.nan # in case we end halfway through a valid packet
-		nan_to_num_transition_indices = np.where(~np.isnan(og_data) & np.isnan(rolled_data))[0] # arrival idxs
-		num_to_nan_transition_indices = np.where(np.isnan(og_data) & ~np.isnan(rolled_data))[0] # ending idxs
-		
-		# now get the actually sampled data as a list of windows
-		arr = df[['x_eh','y_eh','z_eh']].values
-		packet_data = [                                                                               # this zip operation is important because if we end halfway through a packet it is skipped (number of starts and ends must match)
-						arr[packet_start_idx : packet_end_idx] for packet_start_idx,packet_end_idx in zip(nan_to_num_transition_indices,num_to_nan_transition_indices)
-						]
-		
 		# get the arrival time of each packet (note that the arrival time is the end of the data)
-		# TODO: num_to_nan is 1 sample after the last sample in a packet, should we do packet_end_idx-1?
-		time_idxs = df['time']
-		arrival_times = [ 
-						time_idxs[packet_end_idx] for packet_end_idx in num_to_nan_transition_indices
-						]
-
-		# each item in the list is a packet_size x 3 array, so we just stack into one array
-		if len(packet_data) > 0:
-			packet_data = np.stack(packet_data)
-		# we make the list into an array of packet_size x 1
-		if len(arrival_times) > 0:
-			arrival_times = np.stack(arrival_times)
-		
+		# TODO: packet_end_idx is 1 sample after the last sample in a packet, should we do packet_end_idx-1?
+		if fs is None:
+			arrival_times = data_window[packet_end_idxs,0]
+		else:
+			arrival_times = (packet_end_idxs/fs).astype(dtype)
+
 		# store as a tuple
 		# entry 0 is P x 1 and entry 1 is P x packet_size x 3
 		packets[bp] = (arrival_times,packet_data)
 
+	if return_valid == True or return_accounting == True or return_trace == True or features is not None:
+		return SparsifyResult(packets,
+							  e_plots if visualize == True else None,
+							  thresh,
+							  valid_intervals if return_valid == True else None,
+							  accounting if return_accounting == True else None,
+							  traces if return_trace == True else None,
+							  None if features is None else packet_features(packets, features))
 	if visualize == True:
 		return packets, e_plots, thresh
+	return packets
+
+
+def sparsify(data_window: np.ndarray,body_parts: list,packet_size: int,leakage: float,eh,policy='opportunistic',state=None,visualize=False,dtype=None,fs=None,final=False):
+	""" Resumable version of sparsify_data for a stream processed chunk by chunk in bounded memory
+
+	Pass each chunk with the state returned for the previous one and final=True with the last
+	one. The energy is harvested with EnergyHarvester.power_chunk(), which keeps the filtfilt
+	high pass of sparsify_data by holding back the last samples of a chunk (state[bp].harvester.margin,
+	about two minutes, plus an incomplete block of the fft engine) until the next chunk arrives,
+	so the policy runs that far behind the data. Packets that span chunk boundaries are sent
+	when they are complete, so concatenating the packets of all chunks gives the packets of
+	sparsify_data over the whole stream (the harvested energy agrees to rounding). The only
+	other difference to sparsify_data is in e_plots of the dense policy, which cannot correct
+	the last sample of a packet that ends exactly on the last sample released by a chunk.
+
+	Parameters
+	----------
+
+	data_window: np.ndarray
+		the next (3K+1) x T chunk of the stream, same layout as sparsify_data
+
+	body_parts, packet_size, leakage, eh, policy, dtype, fs:
+		same as sparsify_data, must not change between chunks
+
+	state: dict
+		per body part PolicyState returned with the previous chunk, None for the first chunk
+
+	visualize: bool
+		A flag to also return the energy stored on each device for the samples the policy ran
+		over in this chunk
+
+	final: bool
+		whether the chunk ends the stream, the samples held back are then simulated and a
+		packet still in flight is dropped like in sparsify_data
+
+	Returns
+	-------
+
+	packets: dict
+		per body part a tuple (arrival_times, packet_data) of the packets completed in this chunk
+
+	state: dict
+		per body part PolicyState to pass with the next chunk, state[bp].k is the number of
+		samples simulated so far and state[bp].accounting() gives the energy accounting of them
+
+	e_plots: dict
+		only if visualize, per body part the energy stored at samples [k, state[bp].k) where k
+		is the state[bp].k of the previous chunk
+	"""
+
+	dtype = eh.dtype if dtype is None else np.dtype(dtype)
+	data_window = np.asarray(data_window, dtype=dtype)
+	thresh = eh._energy_per_packet(packet_size)
+	state = {bp: None for bp in body_parts} if state is None else state
+
+	packets = {bp: None for bp in body_parts}
+	e_plots = {bp: None for bp in body_parts}
+	new_state = {bp: None for bp in body_parts}
+
+	for i,bp in enumerate(body_parts):
+		if fs is None:
+			import pandas as pd
+			channels = np.array([0,3*i+1,3*i+2,3*i+3]) # time + 3 acc channels of body part
+			data = pd.DataFrame(data_window[:,channels],columns=['time', 'x', 'y','z'])
+		else:
+			channels = np.array([3*i,3*i+1,3*i+2]) # 3 acc channels of body part
+			data = data_window[:,channels]
+		s = state[bp]
+
+		# get energy as function of samples, continuing the previous chunk
+		t_out, p_out, harvester = eh.power_chunk(data, None if s is None else s.harvester, fs=fs, final=final)
+		e_out, harvester = eh.energy_chunk(t_out, p_out, harvester)
+		LEAKAGE_PER_SAMPLE = leakage*harvester.dt # 1uW * 1/fs
+
+		# the policy is behind the data, keep the samples from the last packet it may send on
+		tail = np.zeros((0,len(channels))) if s is None else s.tail
+
+		intervals, e_plot, _, s = _run_policy(e_out, thresh, packet_size, LEAKAGE_PER_SAMPLE, policy, dtype, s, final=final, plot=visualize == True)
+		s.harvester = harvester
+		e_plots[bp] = e_plot
+
+		# a packet is every interval except one cut off by the end of the stream
+		full = intervals[intervals[:,1] < s.k]
+		buf = np.concatenate([tail, data_window[:,channels]]).astype(dtype, copy=False)
+		buf_start = harvester.k_in - len(buf) # stream index of buf[0]
+		sample_idxs = full[:,:1] + np.arange(packet_size) - buf_start
+		packet_data = buf[sample_idxs[:,:,None],np.arange(len(channels)-3,len(channels))]
+		if fs is None:
+			arrival_times = buf[full[:,1]-buf_start,0]
+		else:
+			arrival_times = (full[:,1]/fs).astype(dtype)
+		packets[bp] = (arrival_times,packet_data)
+
+		s.tail = buf[max(s.k-(packet_size+1)-buf_start, 0):].copy()
+		new_state[bp] = s
+
+	if visualize == True:
+		return packets, new_state, e_plots
 	else:
-		return packets
+		return packets, new_state
+
+
+class SeekableSimulation():
+	""" Simulates a long stream once with sparsify and keeps a snapshot of the per body part
+		PolicyState (device state, stored energy, conservative EMA and harvester state) every
+		snapshot_interval samples. Any window can then be simulated again from the nearest
+		snapshot before it, so the work is bounded by the interval instead of the stream length.
+		sparsify gives the packets of sparsify_data, so run() and window() agree with
+		sparsify_data(..., fs=fs) and, made with IncrementalSimulation.seekable(), with the
+		packets and energy the GUI shows
+
+	usage example:
+		sim = SeekableSimulation(data_window, body_parts, 16, 6e-6, eh, fs=25)
+		packets = sim.run()
+		packets, e_plots, state = sim.window(5*3600*25, 5*3600*25 + 60*25) # 1 minute at hour 5
+	"""
+
+	def __init__(self,data_window: np.ndarray,body_parts: list,packet_size: int,leakage: float,eh,policy='opportunistic',fs: float=25,snapshot_interval: int=25*60*10,dtype=None):
+		"""
+		data_window:
+			T x 3K accelerometer data without a time column (e.g. a np.memmap or the transpose
+			of data_streams/*_data.npy), same as sparsify_data(..., fs=fs)
+
+		snapshot_interval:
+			samples between snapshots (10 minutes at 25 Hz by default)
+		"""
+		self.data_window = data_window
+		self.body_parts = body_parts
+		self.packet_size = packet_size
+		self.leakage = leakage
+		self.eh = eh
+		self.policy = policy
+		self.fs = fs
+		self.snapshot_interval = snapshot_interval
+		self.dtype = dtype
+		self.snapshot_ks = np.zeros(0, dtype=np.int64) # samples simulated when each snapshot was taken
+		self.snapshots = [] # per body part PolicyState at that sample, None for the start
+
+	def _sparsify(self, start, end, state, visualize=False):
+		return sparsify(self.data_window[start:end], self.body_parts, self.packet_size, self.leakage, self.eh,
+						self.policy, state, visualize, self.dtype, self.fs, final=end >= len(self.data_window))
+
+	def run(self) -> dict:
+		""" simulates the whole stream and takes the snapshots, returns the packets like
+			sparsify_data """
+		T = len(self.data_window)
+		ks, snapshots, chunks = [0], [None], []
+		state = None
+		for k in range(0, T, self.snapshot_interval):
+			packets, state = self._sparsify(k, k+self.snapshot_interval, state)
+			chunks.append(packets)
+			# the policy runs behind the data (see sparsify), snapshots are taken by the samples it simulated
+			ks.append(state[self.body_parts[0]].k)
+			snapshots.append({bp: s.copy() for bp,s in state.items()})
+		self.snapshot_ks = np.array(ks[:-1], dtype=np.int64)
+		self.snapshots = snapshots[:-1]
+		self.state = state
+		return {bp: (np.concatenate([c[bp][0] for c in chunks]), np.concatenate([c[bp][1] for c in chunks])) for bp in self.body_parts}
+
+	def window(self,start: int,end: int):
+		"""
+		simulates samples [start, end) from the nearest snapshot, run() must be called first
+
+		returns:
+			packets: per body part (arrival_times, packet_data) of the packets arriving in [start, end)
+			e_plots: per body part the energy stored at samples [start, end)
+			state: per body part PolicyState where the simulation stopped, at end or a little after
+		"""
+		if len(self.snapshots) == 0:
+			raise RuntimeError("call run() before window()")
+		T = len(self.data_window)
+		start, end = max(start, 0), min(end, T)
+		i = np.searchsorted(self.snapshot_ks, start, side='right') - 1
+		k = k_sim = int(self.snapshot_ks[i])
+		state = self.snapshots[i]
+		pos = 0 if state is None else state[self.body_parts[0]].harvester.k_in # samples of data passed in
+
+		# pass data in until the policy (which runs behind it) reached end
+		chunks = []
+		while k_sim < end:
+			stop = min(pos + end - k_sim, T)
+			chunks.append(self._sparsify(pos, stop, state, visualize=True))
+			state, pos = chunks[-1][1], stop
+			k_sim = state[self.body_parts[0]].k
+
+		packets, e_plots = {}, {}
+		for bp in self.body_parts:
+			arrival_times = np.concatenate([c[0][bp][0] for c in chunks])
+			packet_data = np.concatenate([c[0][bp][1] for c in chunks])
+			keep = (arrival_times >= start/self.fs) & (arrival_times < end/self.fs)
+			packets[bp] = (arrival_times[keep], packet_data[keep])
+			e_plots[bp] = np.concatenate([c[2][bp] for c in chunks])[start-k:end-k]
+		return packets, e_plots, state
+
+
+class IncrementalSimulation():
+	""" sparsify_data split into its stages (power -> energy -> policy) with the output of every
+		stage cached per body part, so a parameter change only re-runs the stages it affects:
+		power is reused when only efficiency, leakage, packet size or policy change and energy
+		is reused when only leakage, packet size or policy change. Policy results are kept for
+		the last few parameter sets so going back to earlier settings is instant
+
+	usage example:
+		sim = IncrementalSimulation(data_stream, body_parts, eh_params)
+		packets, traces, thresh = sim.run(0.3, 6e-6, 16, 'opportunistic')
+	"""
+
+	def __init__(self,data_stream: np.ndarray,body_parts: list,eh_params: dict,fs: float=25,engine: str='fft',cache_size: int=64):
+		"""
+		data_stream:
+			3K x T accelerometer channels of K body parts without a time column, the layout
+			of data_streams/*_data.npy
+
+		eh_params:
+			EnergyHarvester parameters, the efficiency in it is only the default
+
+		engine:
+			EnergyHarvester engine used for the power stage
+		"""
+		from energy_harvest import EnergyHarvester
+
+		self.data_stream = data_stream
+		self.body_parts = list(body_parts)
+		self.fs = fs
+		self.eh = EnergyHarvester(**eh_params, engine=engine)
+		self.cache_size = cache_size
+		self._power = {} # per body part
+		self._energy = {} # per body part (efficiency, e_out) of the last efficiency
+		self._results = OrderedDict() # per (body part, parameters) (packets, trace)
+
+	def power(self, bp):
+		if bp not in self._power:
+			i = self.body_parts.index(bp)
+			_, self._power[bp] = self.eh.power(self.data_stream[3*i:3*i+3].T, fs=self.fs)
+		return self._power[bp]
+
+	def energy(self, bp, efficiency):
+		if bp not in self._energy or self._energy[bp][0] != efficiency:
+			eh = copy.copy(self.eh)
+			eh.efficiency = efficiency
+			self._energy[bp] = (efficiency, eh.energy(None, self.power(bp), fs=self.fs))
+		return self._energy[bp][1]
+
+	def run_body_part(self,bp,efficiency: float,leakage: float,packet_size: int,policy: str):
+		""" the packets and EnergyTrace of one body part, see run() """
+		key = (bp, efficiency, leakage, packet_size, policy)
+		if key in self._results:
+			self._results.move_to_end(key)
+			return self._results[key]
+
+		e_out = self.energy(bp, efficiency)
+		thresh = self.eh._energy_per_packet(packet_size)
+		LEAKAGE_PER_SAMPLE = leakage*(1/self.fs)
+		intervals, _, log, _ = _run_policy(e_out, thresh, packet_size, LEAKAGE_PER_SAMPLE, policy, plot=False)
+
+		# same packets as sparsify_data(..., fs=fs)
+		i = self.body_parts.index(bp)
+		full = intervals[intervals[:,1] < len(e_out)]
+		sample_idxs = full[:,:1] + np.arange(packet_size)
+		packet_data = self.data_stream[3*i:3*i+3][:,sample_idxs].transpose(1,2,0)
+		result = ((full[:,1]/self.fs, packet_data), EnergyTrace(e_out, log, thresh, packet_size, LEAKAGE_PER_SAMPLE, policy))
+
+		self._results[key] = result
+		if len(self._results) > self.cache_size:
+			self._results.popitem(last=False)
+		return result
+
+	def run(self,efficiency: float,leakage: float,packet_size: int,policy: str,body_parts: list=None):
+		"""
+		simulates the body parts (all by default) with the given parameters
+
+		returns:
+			packets: per body part (arrival_times, packet_data) like sparsify_data
+			traces: per body part EnergyTrace of the stored energy
+			thresh: energy per packet
+		"""
+		body_parts = self.body_parts if body_parts is None else body_parts
+		packets, traces = {}, {}
+		for bp in body_parts:
+			packets[bp], traces[bp] = self.run_body_part(bp, efficiency, leakage, packet_size, policy)
+		return packets, traces, self.eh._energy_per_packet(packet_size)
+
+	def seekable(self,efficiency: float,leakage: float,packet_size: int,policy: str,snapshot_interval: int=25*60*10):
+		""" a SeekableSimulation of the stream with the harvester of this simulation, its packets
+			and energy are those of run() with the same parameters """
+		eh = copy.copy(self.eh)
+		eh.efficiency = efficiency
+		return SeekableSimulation(self.data_stream.T, self.body_parts, packet_size, leakage, eh, policy, self.fs, snapshot_interval)
+
+
+class Stream():
+	""" A label and data stream opened lazily with memory mapping, together with the data derived
+		from it (label transitions and the IncrementalSimulation with its cached packets) so
+		they are dropped together when the stream is closed """
+
+	def __init__(self,name: str,label_path: str,data_path: str,body_parts: list,eh_params: dict,fs: float=25):
+		self.name = name
+		self.fs = fs
+		self.labels = np.load(label_path, mmap_mode='r')
+		self.data = np.load(data_path, mmap_mode='r') # 3K x T
+		self.body_parts = body_parts
+		self.eh_params = eh_params
+		self._time_ax = None
+		self._transitions = None
+		self._simulation = None
+
+	def __len__(self):
+		return len(self.labels)
+
+	@property
+	def time_ax(self):
+		if self._time_ax is None:
+			self._time_ax = np.arange(len(self))/self.fs
+		return self._time_ax
+
+	@property
+	def transitions(self):
+		""" time in seconds of the start of every label segment """
+		if self._transitions is None:
+			self._transitions = label_segments(self.labels)[0]/self.fs
+		return self._transitions
+
+	@property
+	def simulation(self):
+		if self._simulation is None:
+			self._simulation = IncrementalSimulation(self.data, self.body_parts, self.eh_params, self.fs)
+		return self._simulation
+
+
+class StreamLibrary():
+	""" The streams in a directory ({name}_labels.npy and {name}_data.npy pairs, e.g. val and
+		testing in data_streams/) with a bounded LRU of open streams, so switching between them
+		is fast and memory does not grow with the number of streams viewed
+
+	usage example:
+		library = StreamLibrary('data_streams', body_parts, eh_params)
+		stream = library.open('val')
+		packets, traces, thresh = stream.simulation.run(0.3, 6e-6, 16, 'opportunistic')
+	"""
+
+	def __init__(self,directory: str,body_parts: list,eh_params: dict,fs: float=25,max_open: int=3):
+		self.directory = directory
+		self.body_parts = body_parts
+		self.eh_params = eh_params
+		self.fs = fs
+		self.max_open = max_open
+		self._open = OrderedDict()
+
+	def names(self) -> list:
+		""" names of the streams that have both a label and a data file """
+		import os
+
+		files = set(os.listdir(self.directory))
+		return sorted(f[:-len('_labels.npy')] for f in files
+					  if f.endswith('_labels.npy') and f[:-len('_labels.npy')]+'_data.npy' in files)
+
+	def open(self, name: str) -> Stream:
+		if name in self._open:
+			self._open.move_to_end(name)
+			return self._open[name]
+		import os
+
+		stream = Stream(name, os.path.join(self.directory, f'{name}_labels.npy'), os.path.join(self.directory, f'{name}_data.npy'),
+						self.body_parts, self.eh_params, self.fs)
+		self._open[name] = stream
+		if len(self._open) > self.max_open:
+			self._open.popitem(last=False)
+		return stream
+
+
+def intervals_to_mask(intervals: np.ndarray,length: int,dtype=np.float64):
+	""" Expands [start, end) sample intervals into a dense mask that is 1 if valid and NaN if
+		invalid (the format of EnergyHarvester.generate_valid_mask())
+
+	Parameters
+	----------
+
+	intervals: np.ndarray
+		N x 2 array of [start, end) sample intervals, e.g. from sparsify_data(..., return_valid=True)
+
+	length: int
+		number of samples in the stream
+
+	Returns
+	-------
+
+	valid: np.ndarray
+		mask of valid samples, same length as the stream
+	"""
+	# +1 at every start and -1 at every end, the running sum is 1 inside an interval
+	edges = np.zeros(length+1, dtype=np.int64)
+	np.add.at(edges, intervals[:,0], 1)
+	np.add.at(edges, intervals[:,1], -1)
+	valid = np.full(length, np.nan, dtype=dtype)
+	valid[np.cumsum(edges[:-1]) > 0] = 1
+	return valid
+
+
+def mask_data(data: np.ndarray,intervals: np.ndarray):
+	""" Returns a copy of data (T x C) with every sample outside the intervals set to NaN,
+		i.e. the x_eh, y_eh, z_eh columns of the dense representation """
+	data = np.asarray(data)
+	valid = intervals_to_mask(intervals, len(data), np.result_type(data, np.float32))
+	return data * (valid[:,None] if data.ndim == 2 else valid)
+
+
+def interval_sparsity(intervals: np.ndarray,length: int) -> float:
+	""" Fraction of the stream that was sampled, same as EnergyHarvester.get_data_sparsity() of
+		the dense mask but O(intervals) """
+	if len(intervals) == 0:
+		return 0.0
+	return float(np.sum(np.minimum(intervals[:,1], length) - intervals[:,0]))/length
+
+
+def label_segments(label_stream: np.ndarray):
+	""" Run length encodes a label stream into segments of constant activity
+
+	Returns
+	-------
+
+	starts, ends: np.ndarray
+		[start, end) sample index of each segment
+
+	labels: np.ndarray
+		activity label of each segment
+	"""
+	label_stream = np.asarray(label_stream)
+	starts = np.concatenate([[0], np.flatnonzero(label_stream[1:] != label_stream[:-1])+1])
+	ends = np.concatenate([starts[1:], [len(label_stream)]])
+	return starts, ends, label_stream[starts]
+
+
+def activity_report(label_stream: np.ndarray,valid: dict,label_map: dict=None,traces: dict=None,fs: float=25):
+	""" Sparsity, packet rate and energy surplus per (activity, body part)
+
+	The label stream is run length encoded once, packets are assigned to the segment they
+	arrive in with searchsorted and everything is aggregated per activity with bincount, so
+	the cost is linear in the number of packets plus the number of segments.
+
+	Parameters
+	----------
+
+	label_stream: np.ndarray
+		activity label of each sample, e.g. data_streams/val_labels.npy
+
+	valid: dict
+		per body part the sampled intervals from sparsify_data(..., return_valid=True)
+
+	label_map: dict
+		optional names of the activities
+
+	traces: dict
+		optional per body part EnergyTrace from sparsify_data(..., return_trace=True), needed
+		for the energy columns
+
+	fs: float
+		sampling rate in Hz
+
+	Returns
+	-------
+
+	report: pd.DataFrame
+		one row per (activity, body part) with the number of segments, seconds, packets,
+		packet_rate (packets per second), sparsity (fraction of samples sampled) and with
+		traces, harvested energy, spent energy (everything the policy debited: restarts,
+		packets, leakage and the surplus the dense policy drops) and energy_surplus
+		(harvested minus spent, J). Over all activities the surplus adds up to the energy
+		left stored at the end plus the harvest clipped at the storage limit (net of
+		overdraft), see PolicyState.accounting()
+	"""
+	import pandas as pd
+
+	starts, ends, labels = label_segments(label_stream)
+	T = len(label_stream)
+	activities, seg_activity = np.unique(labels, return_inverse=True)
+	A = len(activities)
+	samples = np.bincount(seg_activity, weights=ends-starts, minlength=A)
+	segments = np.bincount(seg_activity, minlength=A)
+
+	rows = []
+	for bp, intervals in valid.items():
+		intervals = np.asarray(intervals, dtype=np.int64).reshape(-1,2)
+
+		# packets arrive at the end of their interval, a cut off one never arrives
+		arrivals = intervals[intervals[:,1] < T,1]
+		seg = np.searchsorted(starts, arrivals, side='right') - 1
+		packets = np.bincount(seg_activity[seg], minlength=A)
+
+		# sampled samples before each segment boundary, from the cumulative interval lengths
+		bounds = np.concatenate([starts, [T]])
+		cum = np.concatenate([[0], np.cumsum(np.minimum(intervals[:,1], T) - intervals[:,0])])
+		n = np.searchsorted(intervals[:,1], bounds, side='right') # intervals done by the boundary
+		partial = np.zeros(len(bounds), dtype=np.int64)
+		inside = n < len(intervals)
+		partial[inside] = np.maximum(bounds[inside] - intervals[n[inside],0], 0)
+		sampled = np.diff(cum[n] + partial)
+		sampled = np.bincount(seg_activity, weights=sampled, minlength=A)
+
+		report = {
+			'activity': activities,
+			'body_part': bp,
+			'segments': segments,
+			'seconds': samples/fs,
+			'packets': packets,
+			'packet_rate': packets/(samples/fs),
+			'sparsity': sampled/samples
+		}
+		if traces is not None:
+			trace = traces[bp]
+			e_out = np.asarray(trace.e_out[np.minimum(bounds, T-1)], dtype=np.float64)
+			harvested = np.bincount(seg_activity, weights=np.diff(e_out), minlength=A)
+			# energy the policy debited before each boundary, from the event log of the trace,
+			# only runs of leaking samples change it within a log segment (a packet is paid
+			# for in one go when it is done)
+			log = trace.log
+			seg = np.searchsorted(log['k'], bounds, side='right') - 1
+			debit = log['debit'][seg] + np.where(log['kind'][seg] == LEAK, (bounds - log['k'][seg])*trace.LEAKAGE_PER_SAMPLE, 0.0)
+			spent = np.bincount(seg_activity, weights=np.diff(debit), minlength=A)
+			report['harvested'] = harvested
+			report['spent'] = spent
+			report['energy_surplus'] = harvested - spent
+		rows.append(pd.DataFrame(report))
+
+	report = pd.concat(rows, ignore_index=True)
+	if label_map is not None:
+		report.insert(1, 'activity_name', report['activity'].map(label_map))
+	return report
+
+
+def _run_policy(e_out: np.ndarray,thresh: float,packet_size: int,LEAKAGE_PER_SAMPLE: float,policy: str,dtype=np.float64,state=None,final=True,plot=True):
+	""" Runs the energy spending policy of one device over its harvested energy
+
+	Energy spent is never subtracted from the rest of the cumulative trace, instead it is
+	accumulated in a float64 running debit and the stored energy at sample k is
+	e_out[k] - debit. This keeps the loop O(T) and the energy level is computed in float64
+	whatever dtype the returned traces are stored in.
+
+	The loop steps one sample at a time and a packet in flight is finished at the sample
+	after it, so a stream can be fed in chunks by passing the returned state back in.
+
+	Parameters
+	----------
+
+	e_out: np.ndarray
+		cumulative harvested energy (float64) as returned by EnergyHarvester.energy()
+
+	thresh: float
+		energy needed to sample and transmit one packet
+
+	packet_size: int
+		number of samples in a packet
+
+	LEAKAGE_PER_SAMPLE: float
+		energy leaked per sample
+
+	policy: str
+		'opportunistic', 'dense' or 'conservative_<fraction>'
+
+	dtype: np.dtype
+		type of the returned arrays
+
+	state: PolicyState
+		state at the start of e_out, None to start a new stream
+
+	final: bool
+		whether e_out ends the stream, a packet still in flight is then cut off
+
+	plot: bool
+		whether to build e_plot, callers that only need the intervals, log or state skip
+		the O(T) array
+
+	Returns
+	-------
+
+	intervals: np.ndarray
+		N x 2 array of [start, end) sample intervals where data was sampled, indexed from
+		the start of the stream
+
+	e_plot: np.ndarray
+		energy stored on the device at each sample, None if not plot
+
+	log: np.ndarray
+		event log (EVENT_DTYPE) of the segments e_plot is made of, the logs of consecutive
+		chunks can be concatenated. See EnergyTrace
+
+	state: PolicyState
+		state at the end of e_out
+	"""
+
+	T = len(e_out)
+	# python floats are much faster to step through than numpy scalars, converted a block
+	# at a time so the list (~32 B per sample) does not grow with the stream
+	e_raw = chain.from_iterable(np.asarray(e_out[b:b+POLICY_BLOCK], dtype=np.float64).tolist() for b in range(0, T, POLICY_BLOCK))
+	thresh = float(thresh)
+
+	# assume max energy we can store is 3*thresh needed to sample/TX
+	MAX_E = INIT_OVERHEAD + thresh
+	# print(MAX_E)
+
+	# sampled intervals, appended as packets are sent
+	intervals = []
+	e_plot = np.empty(T, dtype=dtype) if plot else None
+
+	conservative = 'conservative' in policy
+	dense = policy == 'dense'
+	if conservative:
+		fraction = float(policy.split('_')[1])
+	else:
+		fraction = 1
+
+	charge_up_thresh = fraction*thresh # conservative threshold for charging up
+	alpha = 0.65
+
+	# assume a linear energy usage over the course of a packet
+	# i.e., thresh/packet_size used per sample. The array is
+	# of size packet_size+1 because it starts at 0, then increments
+	# by thresh/packet_size for each sample
+	linear_usage = np.linspace(0,thresh,packet_size+1).tolist()
+	linear_leakage = np.linspace(0,LEAKAGE_PER_SAMPLE*packet_size,packet_size+1).tolist()
+	if dense:
+		linear_usage = [0.0]*(packet_size+1) # dense only pays for leakage during a packet
+
+	if state is None:
+		state = PolicyState(e_target=charge_up_thresh if conservative else thresh)
+	else:
+		state = state.copy()
+	STATE = state.device_state
+	e_target = state.e_target
+	st, en, iat_mu, wt = state.st, state.en, state.iat_mu, state.wt
+	debit = state.debit # energy spent so far, applied to every sample from k onwards
+	e_prev = state.e_prev # stored energy at k-1
+	packet_start = state.packet_start # first sample of the packet in flight, -1 if none
+	k0 = state.k # index of e_out[0] in the stream
+	# accounting counters, only touched on events so the loop stays as fast
+	restarts, brownouts, state_since = state.restarts, state.brownouts, state.state_since
+	n_packets, e_packets, e_clipped = state.n_packets, state.e_packets, state.e_clipped
+	state_samples = list(state.state_samples)
+	# event log, a new segment whenever the debit stops changing linearly (see EnergyTrace)
+	log = []
+	dirty = True
+	leaking = False
+
+	# iterate over energy values (need to change this code for other policies)
+	for i, e_in in enumerate(e_raw):
+		k = k0 + i
+
+		if packet_start >= 0:
+			j = k - packet_start
+			# still sampling the packet
+			if j <= packet_size:
+				e = e_in - debit - linear_usage[j] - linear_leakage[j]
+				if plot:
+					e_plot[i] = e
+				e_prev = e
+				continue
+
+			# the packet is done, the energy after it decides what it cost
+			intervals.append((packet_start,packet_start+packet_size))
+			packet_start = -1
+			n_packets += 1
+			e_next = e_in - debit
+			if dense:
+				surp = e_next - MAX_E
+				if surp > 0:
+					e_prev -= 2*surp
+					if plot and i > 0:
+						e_plot[i-1] -= 2*surp
+					# the last sample of the packet drops the surplus, the packet started in
+					# an earlier chunk if its segment is not in this log
+					if log and log[-1][0] == intervals[-1][0]:
+						log[-1] = log[-1][:3] + (2*surp,)
+					else:
+						log.append((intervals[-1][0], debit, PACKET, 2*surp))
+					debit += 2*surp
+					e_clipped += 2*surp
+					e_next -= 2*surp
+				if e_next > 0:
+					debit += LEAKAGE_PER_SAMPLE*packet_size
+			else:
+				if e_next > 0:
+					# since the energy is cumulative, subtract thresh from rest of it
+					debit += thresh
+					e_packets += thresh
+					e_next -= thresh
+				if e_next > 0:
+					debit += LEAKAGE_PER_SAMPLE
+					e_next -= LEAKAGE_PER_SAMPLE
+
+			if conservative:
+				# new target
+				e_target = e_next+charge_up_thresh
+				if e_target > MAX_E:
+					e_target = MAX_E
+
+		# house keeping, make sure energy is clipped to bounds
+		e = e_in - debit
+		if e > MAX_E:
+			e = MAX_E
+		elif e < 0:
+			e = 0
+		if dirty or (e > 0) != leaking:
+			leaking = e > 0
+			log.append((k, debit, LEAK if leaking else HOLD, 0.0))
+			dirty = False
+
+		# the thresholds each policy charges up to
+		if conservative:
+			if e_target > MAX_E:
+				e_target = MAX_E
+			on_thresh = 2*LEAKAGE_PER_SAMPLE + INIT_OVERHEAD
+			tx_thresh = e_target
+		else:
+			on_thresh = 5*LEAKAGE_PER_SAMPLE + INIT_OVERHEAD
+			tx_thresh = thresh
+
+		# update state
+		PREV_STATE = STATE
+		if STATE == DeviceState.OFF: # turn on when have init overhead
+			if e >= on_thresh:
+				STATE = DeviceState.ON_CANT_TX
+				debit += INIT_OVERHEAD # apply overhead instantly (from k+1 onwards)
+				dirty = True
+		elif STATE == DeviceState.ON_CAN_TX:
+			if e == 0: # device died
+				STATE = DeviceState.OFF
+			elif e < tx_thresh:#+LEAKAGE_PER_SAMPLE*packet_size:
+				STATE = DeviceState.ON_CANT_TX
+		elif STATE == DeviceState.ON_CANT_TX:
+			if e >= tx_thresh:#+LEAKAGE_PER_SAMPLE*packet_size:
+				STATE = DeviceState.ON_CAN_TX
+			elif e == 0:
+				STATE = DeviceState.OFF
+		if STATE is not PREV_STATE:
+			state_samples[PREV_STATE.value] += k - state_since
+			state_since = k
+			if STATE == DeviceState.OFF:
+				brownouts += 1
+			elif PREV_STATE == DeviceState.OFF:
+				restarts += 1
+
+		if conservative:
+			# update state vars while device is on
+			if STATE != DeviceState.OFF:
+				if not np.isnan(en): # increment wait time between last packet and now
+					wt = k - en
+			else:
+				st = np.nan
+				en = np.nan
+				iat_mu = np.nan
+				wt = np.nan
+				e_target = fraction*thresh
+
+		# we hit the transmit threshold, start sampling a packet
+		if STATE == DeviceState.ON_CAN_TX:
+			if conservative:
+				# update running mean of iat
+				if np.isnan(st):
+					st = k
+				elif np.isnan(en):
+					en = k
+					iat_mu = en-st
+				else:
+					st = en
+					en = k
+					iat_mu = alpha*(en-st)+(1-alpha)*iat_mu
+
+			packet_start = k
+			if plot:
+				e_plot[i] = e
+			e_prev = e
+			if log and log[-1][0] == k:
+				log.pop()
+			log.append((k, debit, PACKET, 0.0))
+			dirty = True
+
+		else:
+			if conservative and STATE == DeviceState.ON_CANT_TX:
+				# e-LEAKAGE_PER_SAMPLE, written like the next sample's energy so that a flat
+				# harvest still compares equal and triggers the state change
+				e_trigger = e_in - (debit + LEAKAGE_PER_SAMPLE) if e < MAX_E else e-LEAKAGE_PER_SAMPLE
+				# have enough energy and waited a while
+				if e > thresh and not np.isnan(wt) and wt > 2*iat_mu:
+					e_target = e_trigger # trigger a state change
+				# have enough energy and about to transition to cant zone
+				elif e > thresh and ((e + 5*((e-LEAKAGE_PER_SAMPLE)-e_prev)) < thresh):
+					e_target = e_trigger # trigger a state change
+
+			# apply leakage
+			if e > 0:
+				e -= LEAKAGE_PER_SAMPLE
+				debit += LEAKAGE_PER_SAMPLE
+			# clip at min and max value
+			if e > MAX_E:
+				e = MAX_E
+			elif e < 0:
+				e = 0
+			# go to next samples
+			if plot:
+				e_plot[i] = e
+			e_prev = e
+
+	# we are within one packet of the end of the data
+	if final and packet_start >= 0:
+		intervals.append((packet_start,k0+T))
+
+	state.device_state = STATE
+	state.e_target = e_target
+	state.st, state.en, state.iat_mu, state.wt = st, en, iat_mu, wt
+	state.debit = debit
+	state.e_prev = e_prev
+	state.packet_start = packet_start
+	state.k = k0 + T
+	state.restarts, state.brownouts, state.state_since = restarts, brownouts, state_since
+	state.n_packets, state.e_packets, state.e_clipped = n_packets, e_packets, e_clipped
+	state.state_samples = state_samples
+	if T > 0:
+		state.e_harvested = e_in
+		state.e_stored = min(max(e_in - debit, 0.0), MAX_E)
+	return np.array(intervals, dtype=np.int64).reshape(-1,2), e_plot, np.array(log, dtype=EVENT_DTYPE), state
+
+
+PACKET_FEATURES = ('mean','var','min','max','energy','dt')
+AXES = ('x','y','z')
+
+def feature_names(features=PACKET_FEATURES) -> list:
+	""" column names of the matrices of packet_features(), e.g. mean_x, mean_y, mean_z, ..., energy, dt """
+	names = []
+	for f in features:
+		if f in ('mean','var','min','max'):
+			names += [f'{f}_{axis}' for axis in AXES]
+		elif f in ('energy','dt'):
+			names.append(f)
+		else:
+			raise ValueError(f"unknown packet feature '{f}', must be one of {PACKET_FEATURES}")
+	return names
+
+
+def packet_features(packets: dict,features=PACKET_FEATURES) -> dict:
+	""" Per packet features of the packets of all body parts, computed in one vectorized pass
+		over the packet data of all body parts
+
+	Parameters
+	----------
+
+	packets: dict
+		per body part a tuple (arrival_times, packet_data) as returned by sparsify_data
+
+	features: tuple
+		features to compute, in column order (see feature_names()):
+		'mean', 'var', 'min', 'max': per axis over the samples of the packet
+		'energy': mean squared magnitude of the acceleration, (x^2+y^2+z^2)/packet_size
+		'dt': time in seconds since the previous packet of the body part (nan for the first)
+
+	Returns
+	-------
+
+	features: dict
+		per body part a P x F array in the dtype of the packet data
+	"""
+
+	feature_names(features) # validates the names
+	counts = np.array([len(arrival_times) for arrival_times,_ in packets.values()])
+	data = np.concatenate([packet_data for _,packet_data in packets.values()]) # P x packet_size x 3
+
+	columns = []
+	for f in features:
+		if f == 'mean':
+			columns.append(data.mean(axis=1))
+		elif f == 'var':
+			columns.append(data.var(axis=1))
+		elif f == 'min':
+			columns.append(data.min(axis=1))
+		elif f == 'max':
+			columns.append(data.max(axis=1))
+		elif f == 'energy':
+			columns.append(np.einsum('psa,psa->p', data, data)[:,None]/data.shape[1])
+		elif f == 'dt':
+			arrival_times = np.concatenate([np.asarray(at, dtype=np.float64).reshape(-1) for at,_ in packets.values()])
+			dt = np.diff(arrival_times, prepend=np.nan)
+			dt[(np.cumsum(counts)-counts)[counts > 0]] = np.nan # first packet of each body part
+			columns.append(dt[:,None])
+
+	X = np.concatenate(columns, axis=1).astype(data.dtype, copy=False) if columns else np.zeros((len(data),0), dtype=data.dtype)
+	return dict(zip(packets.keys(), np.split(X, np.cumsum(counts)[:-1])))
+
+
+def assemble_windows(packets: dict,body_parts: list,length: int,window: int=50,stride: int=None,imputation: str='hold',fs: float=25,t0: float=0.0):
+	""" Builds fixed length model windows from the sparse packets of sparsify_data
+
+	A window ending at sample e covers samples [e-window, e) and only sees the packets that
+	have arrived by then (arrival index <= e). Samples that were not received are imputed.
+
+	Parameters
+	----------
+
+	packets: dict
+		per body part a tuple (arrival_times, packet_data) as returned by sparsify_data
+
+	body_parts: list
+		the body parts to stack, in channel order
+
+	length: int
+		number of samples in the stream
+
+	window: int
+		number of samples per window (e.g. 50 = 2s at 25Hz)
+
+	stride: int
+		number of samples between consecutive windows, defaults to window (no overlap)
+
+	imputation: str
+		'hold' to repeat the last received sample (zeros before the first packet) or
+		'zero' to fill missing samples with zeros
+
+	fs: float
+		sampling rate in Hz
+
+	t0: float
+		time of sample 0 in seconds
+
+	Returns
+	-------
+
+	windows: np.ndarray
+		N x window x 3K array, columns ordered armX | armY | armZ | legX | ...
+
+	mask: np.ndarray
+		N x window x K boolean array, True where the sample was received
+
+	staleness: np.ndarray
+		N x K time in seconds since the last packet of each body part arrived,
+		np.inf if none has arrived yet
+
+	window_times: np.ndarray
+		N end time of each window in seconds
+	"""
+	stride = window if stride is None else stride
+	window_ends = np.arange(window, length+1, stride)
+	timelines = [_packet_timeline(_arrival_index(packets[bp][0], fs, t0), packets[bp][1], length) for bp in body_parts]
+	windows, mask, staleness = _assemble(timelines, window_ends, window, imputation, fs)
+	return windows, mask, staleness, t0 + window_ends/fs
+
+
+def iter_windows(chunks,body_parts: list,window: int=50,stride: int=None,imputation: str='hold',fs: float=25,t0: float=0.0,batch_size: int=1024):
+	""" Streaming version of assemble_windows() for packets that come in chunk by chunk
+
+	Yields the (windows, mask, staleness, window_times) of assemble_windows() over the whole
+	stream in batches of at most batch_size windows, each as soon as every packet it can see
+	has come in. Between chunks only the packets the next windows can see are kept, plus the
+	last one before them for the imputation and the staleness, so memory does not grow with
+	the stream.
+
+	usage example:
+		def chunks():
+			state = None
+			for start in range(0, T, chunk):
+				packets, state = sparsify(data_window[start:start+chunk], body_parts, 16, 6e-6, eh, state=state, fs=25, final=start+chunk >= T)
+				yield packets, state[body_parts[0]].k
+		for windows, mask, staleness, window_times in iter_windows(chunks(), body_parts):
+			...
+
+	Parameters
+	----------
+
+	chunks: iterable
+		(packets, k) per chunk, the packets completed in the chunk (per body part a tuple
+		(arrival_times, packet_data) like sparsify_data) and the number of samples simulated
+		so far, e.g. state[bp].k of sparsify. A packet in flight arrives at k-1 at the earliest,
+		so the windows ending before that are complete. Once chunks is exhausted the last k is
+		the length of the stream and the remaining windows are yielded
+
+	body_parts, window, stride, imputation, fs, t0:
+		same as assemble_windows()
+
+	batch_size: int
+		maximum number of windows per yield
+	"""
+	stride = window if stride is None else stride
+	arrivals = {bp: np.zeros(0, dtype=np.int64) for bp in body_parts}
+	packet_data = {bp: np.zeros((0,0,3)) for bp in body_parts}
+	end = window # end of the next window
+
+	def windows_until(last_end):
+		nonlocal end
+		window_ends = np.arange(end, last_end+1, stride)
+		for b in range(0, len(window_ends), batch_size):
+			ends = window_ends[b:b+batch_size]
+			# drop the packets before the windows except the last one
+			for bp in body_parts:
+				first = max(np.searchsorted(arrivals[bp], ends[0]-window, side='right')-1, 0)
+				arrivals[bp], packet_data[bp] = arrivals[bp][first:], packet_data[bp][first:]
+			# the windows and the packets they see, on a local sample axis
+			start = min([ends[0]-window] + [arrivals[bp][0]-packet_data[bp].shape[1] for bp in body_parts if len(arrivals[bp]) > 0])
+			timelines = [_packet_timeline(arrivals[bp]-start, packet_data[bp], ends[-1]-start) for bp in body_parts]
+			windows, mask, staleness = _assemble(timelines, ends-start, window, imputation, fs)
+			yield windows, mask, staleness, t0 + ends/fs
+		if len(window_ends) > 0:
+			end = window_ends[-1] + stride
+
+	k = 0
+	for packets, k in chunks:
+		for bp in body_parts:
+			arrival_times, data = packets[bp]
+			if len(arrival_times) == 0:
+				continue
+			arrivals[bp] = np.concatenate([arrivals[bp], _arrival_index(arrival_times, fs, t0)])
+			data = np.asarray(data)
+			packet_data[bp] = data if len(packet_data[bp]) == 0 else np.concatenate([packet_data[bp], data])
+		yield from windows_until(k-2)
+	yield from windows_until(k)
+
+
+def _arrival_index(arrival_times: np.ndarray,fs: float,t0: float):
+	""" sample index each packet arrives at (one after its last sample) """
+	return np.round((np.asarray(arrival_times, dtype=np.float64).reshape(-1)-t0)*fs).astype(np.int64)
+
+
+def _packet_timeline(ends: np.ndarray,packet_data: np.ndarray,length: int):
+	""" Lays the packets of one body part out on the sample axis, ends are their arrival indices
+
+	Returns the per sample values (length x 3), the arrival index of the packet each sample
+	came in (-1 if never received), the last received sample at or before each sample, the
+	last received sample before the packet each sample came in, and the packet arrival indices
+	"""
+	packet_data = np.asarray(packet_data)
+	P = len(ends)
+	packet_size = packet_data.shape[1] if P > 0 else 0
+	keep = ends <= length
+	ends, packet_data = ends[keep], packet_data[keep]
+	starts = ends - packet_size
+
+	values = np.zeros((length,3), dtype=packet_data.dtype if P > 0 else np.float64)
+	arrival_idx = np.full(length, -1, dtype=np.int64)
+	sample_idxs = (starts[:,None] + np.arange(packet_size)).ravel()
+	values[sample_idxs] = packet_data.reshape(-1,3)
+	arrival_idx[sample_idxs] = np.repeat(ends, packet_size)
+
+	# index of the last received sample, -1 before the first packet
+	last = np.maximum.accumulate(np.where(arrival_idx >= 0, np.arange(length), -1))
+	last_before = np.full(length, -1, dtype=np.int64)
+	last_before[sample_idxs] = np.repeat(np.where(starts > 0, last[np.maximum(starts-1,0)], -1), packet_size)
+	return values, arrival_idx, last, last_before, ends
+
+
+def _assemble(timelines: list,window_ends: np.ndarray,window: int,imputation: str,fs: float):
+	""" Vectorized window assembly for the given window end indices, see assemble_windows() """
+	if imputation not in ['hold','zero']:
+		raise ValueError("imputation must be 'hold' or 'zero'")
+
+	N, K = len(window_ends), len(timelines)
+	positions = window_ends[:,None] - window + np.arange(window) # N x window sample indices
+	dtype = np.result_type(*[tl[0] for tl in timelines]) if K > 0 else np.float64
+	windows = np.zeros((N,window,3*K), dtype=dtype)
+	mask = np.zeros((N,window,K), dtype=bool)
+	staleness = np.full((N,K), np.inf)
+
+	for i, (values, arrival_idx, last, last_before, ends) in enumerate(timelines):
+		# last received sample, skipping a packet that only arrives after the window ends
+		src = last[positions]
+		late = (src >= 0) & (arrival_idx[src] > window_ends[:,None])
+		src = np.where(late, last_before[src], src)
+		received = src == positions
+		mask[:,:,i] = received
+
+		if imputation == 'hold':
+			fill = src >= 0
+		else:
+			fill = received
+		windows[:,:,3*i:3*i+3] = np.where(fill[:,:,None], values[np.maximum(src,0)], 0)
+
+		# time since the last packet arrived
+		last_packet = np.searchsorted(ends, window_ends, side='right') - 1
+		arrived = last_packet >= 0
+		staleness[arrived,i] = (window_ends[arrived] - ends[last_packet[arrived]])/fs
+
+	return windows, mask, staleness
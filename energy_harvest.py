@@ -1,7 +1,12 @@
-import pandas as pd
 import numpy as np
-import scipy.signal as signal
-import scipy
+import copy
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# scipy and pandas are only imported by the methods that use them, so importing
+# this module (e.g. in short lived worker processes) only loads numpy
 
 class EnergyHarvester():
     """
@@ -20,6 +25,8 @@ class EnergyHarvester():
             'efficiency': 0.25
         }
         harvester = EnergyHarvester(**energy_params)
+        # or EnergyHarvester(**energy_params, dtype=np.float32) for reduced precision
+        # or EnergyHarvester(**energy_params, engine='fft') for long signals
         time, power = harvester.power(data)
         energy = harvester.energy(power, time)
     """
@@ -29,7 +36,9 @@ class EnergyHarvester():
                  spring_const=0.17,
                  spring_damp=0.0055,
                  disp_max=0.01,
-                 efficiency=0.5) -> None:
+                 efficiency=0.5,
+                 dtype=np.float64,
+                 engine='lsim') -> None:
         """
         proof_mass:
             mass of the proof mass in kg
@@ -45,15 +54,32 @@ class EnergyHarvester():
 
         efficiency:
             fraction of energy actually harvested [0,1]
+
+        dtype:
+            floating point type of the power output and of the traces built
+            from it (e.g. np.float32 to halve their memory). The computation
+            itself stays float64: power() runs the filter, the proof mass
+            response and the gradient in float64 and only casts the result,
+            energy() accumulates in float64
+
+        engine:
+            how power() solves the proof mass response, 'lsim' (scipy.signal.lsim)
+            or 'fft' (the same discretization applied as a precomputed impulse
+            response with FFT overlap-add convolution, much faster on long signals)
         """
         self.proof_mass = proof_mass
         self.spring_const = spring_const
         self.spring_damp = spring_damp
         self.disp_max = disp_max
         self.efficiency = efficiency
+        self.dtype = np.dtype(dtype)
+        if engine not in ['lsim', 'fft']:
+            raise ValueError("engine must be 'lsim' or 'fft'")
+        self.engine = engine
+        self._response_cache = {}
 
-    def power(self, data : pd.DataFrame, 
-              use_x=True, use_y=True, use_z=True) -> (np.ndarray, np.ndarray):
+    def power(self, data : 'pd.DataFrame', 
+              use_x=True, use_y=True, use_z=True, fs=None) -> (np.ndarray, np.ndarray):
         """
         calculates power per unit time, units in Watts
 
@@ -61,32 +87,44 @@ class EnergyHarvester():
             pandas dataframe with columns: time, x, y, z
             x, y, z units should be in m/s^2
             time units should be in seconds
+            if fs is given the time column is not needed and data can also be
+            a T x 3 numpy array of x, y, z
 
         use_x, use_y, use_z:
             boolean values indicating whether or not to use the respective
             axis in the energy harvest calculation
 
+        fs:
+            sampling rate in Hz of uniformly sampled data, the scalar sample
+            spacing is used instead of a time column
+
         returns:
-            time_out: numpy array of time values in seconds
-            power_out: numpy array of power values in Watts
+            time_out: numpy array of time values in seconds (None if fs is given)
+            power_out: numpy array of power values in Watts (self.dtype)
         """
 
+        from scipy import signal
+
         # validate input
-        if not isinstance(data, pd.DataFrame):
-            raise TypeError("data must be a pandas dataframe")
-        time = data.get('time', None)
-        accx = data.get('x', None)
-        accy = data.get('y', None)
-        accz = data.get('z', None)
-        if any([x is None for x in [time, accx, accy, accz]]):
-            raise ValueError("data must have columns: time, x, y, z")
+        time, accx, accy, accz = self._get_columns(data, fs)
         
         # preprocess
         amag = np.sqrt(((accx**2) if use_x else 0) + 
                        ((accy**2) if use_y else 0) + 
                        ((accz**2) if use_z else 0))
-        t_step = np.mean(np.diff(time))   # these should all be the same value
-        fs = 1/t_step
+        if fs is None:
+            # positional from here on, the index of the dataframe can start anywhere
+            t = np.asarray(time)
+            t_step = np.mean(np.diff(t))   # these should all be the same value
+            fs = 1/t_step
+            if t.dtype != np.float64:
+                # reduced precision time stamps are not evenly spaced enough for lsim,
+                # rebuild them in float64 from the (uniform) sample spacing
+                t = float(t[0]) + np.arange(len(t))*np.float64(t_step)
+            dt = t[1]-t[0]
+        else:
+            t = None
+            dt = 1/fs
         # generate filter (3rd order butterworth, 0.1Hz cutoff)
         # cutoff is specified as a fraction of the nyquist frequency (fs/2)
         iirb, iira = signal.butter(3, (2*0.1)/fs, 'highpass')
@@ -100,32 +138,333 @@ class EnergyHarvester():
                  self.spring_const/self.proof_mass])
         
         # calculate position of proof mass
-        time_out, zpos, _ = signal.lsim(tf, filter_amag, time)
+        if self.engine == 'fft':
+            zpos = self._proof_mass_fft(filter_amag, dt)
+        else:
+            # lsim always needs the time values
+            _, zpos, _ = signal.lsim(tf, filter_amag, np.arange(len(amag))*dt if t is None else t)
         zpos = np.clip(zpos.flatten(), -self.disp_max, self.disp_max)
 
         # calculate velocity of proof mass
-        zvel = np.gradient(zpos, time)
+        zvel = np.gradient(zpos, dt if t is None else t)
 
         # calculate power: power = damping * velocity^2
         damp_power = self.spring_damp * (zvel**2)
 
-        return time_out, damp_power
+        return t, damp_power.astype(self.dtype, copy=False)
+
+    @staticmethod
+    def _get_columns(data, fs):
+        # time, x, y, z columns of the input of power(), time is None if fs is given
+        if fs is not None and isinstance(data, np.ndarray):
+            if data.ndim != 2 or data.shape[1] != 3:
+                raise ValueError("data must be a T x 3 array of x, y, z")
+            return None, data[:,0], data[:,1], data[:,2]
+        import pandas as pd
+        if not isinstance(data, pd.DataFrame):
+            raise TypeError("data must be a pandas dataframe")
+        time = data.get('time', None) if fs is None else None
+        accx = data.get('x', None)
+        accy = data.get('y', None)
+        accz = data.get('z', None)
+        if any([x is None for x in [accx, accy, accz]]) or (fs is None and time is None):
+            raise ValueError("data must have columns: time, x, y, z")
+        return time, accx, accy, accz
 
-    def energy(self, time : np.ndarray, power : np.ndarray) -> np.ndarray:
+    def energy(self, time : np.ndarray, power : np.ndarray, fs=None) -> np.ndarray:
         """
         calculates energy per unit time, units in Joules
 
         time:
-            numpy array of time values in seconds
+            numpy array of time values in seconds, ignored if fs is given
 
         power:
             numpy array of power values in Watts
+
+        fs:
+            sampling rate in Hz of uniformly sampled power
         
         returns:
             energy: numpy array of energy values in Joules, same length as time and power
+
+        the integral is always accumulated in float64 regardless of self.dtype,
+        a float32 running sum can no longer resolve the per sample increments
+        (~1e-7 J) once the total reaches a few Joules
         """
-        return scipy.integrate.cumtrapz(power, time, initial=0)*self.efficiency
+        power = np.asarray(power, dtype=np.float64)
+        if fs is not None:
+            return _cumtrapz(power, dx=1/fs)*self.efficiency
+        time = np.asarray(time, dtype=np.float64)
+        return _cumtrapz(power, np.diff(time))*self.efficiency
     
+    def power_chunk(self, data : 'pd.DataFrame', state=None,
+                    use_x=True, use_y=True, use_z=True, fs=None, final=False) -> (np.ndarray, np.ndarray, 'HarvesterState'):
+        """
+        power() for a stream processed in consecutive chunks
+
+        the high pass filter is still filtfilt: the forward pass continues from the
+        last chunk and the backward pass starts state.margin samples after the last
+        sample it releases, by which point the high pass has settled far below double
+        precision, so it agrees with the backward pass from the end of the stream. The
+        last margin samples of a chunk are held back until the next chunk (or final)
+        arrives. The proof mass continues from the lsim (first order hold) state of the
+        last sample, the fft engine convolves the same blocks as _proof_mass_fft and
+        also holds back the samples of an incomplete block. Concatenating the output of
+        all chunks gives power() over the whole stream (to rounding)
+
+        data:
+            same as power(), the next chunk of the stream
+
+        state:
+            HarvesterState returned with the previous chunk, None for the first chunk
+            (which needs more than 12 samples for the padding of filtfilt)
+
+        fs:
+            same as power(), only used for the first chunk. Without it the sample
+            spacing is taken from the first two time stamps
+
+        final:
+            whether the chunk ends the stream, the samples held back are then released
+
+        returns:
+            time_out: numpy array of time values in seconds of the samples released by
+                this chunk (None if fs is given)
+            power_out: numpy array of power values in Watts (self.dtype) of the samples
+                released by this chunk, they follow those released by the previous one
+            state: HarvesterState to pass with the next chunk
+        """
+        from scipy import signal
+
+        time, accx, accy, accz = self._get_columns(data, fs)
+
+        amag = np.asarray(np.sqrt(((accx**2) if use_x else 0) + 
+                                  ((accy**2) if use_y else 0) + 
+                                  ((accz**2) if use_z else 0)), dtype=np.float64)
+        if state is None and fs is not None:
+            state = HarvesterState(fs)
+        elif state is None:
+            # from the first two samples so it does not depend on the chunk length
+            t = np.asarray(time[:2], dtype=np.float64)
+            state = HarvesterState(1/(t[1]-t[0]), t[1]-t[0], t0=t[0])
+        else:
+            state = state.copy()
+        if time is not None:
+            time = np.asarray(time)
+            if time.dtype != np.float64:
+                # rebuilt in float64 like in power()
+                time = state.t0 + np.arange(state.k_in, state.k_in+len(time))*state.dt
+
+        # same 3rd order butterworth and odd padding as filtfilt in power()
+        iirb, iira = signal.butter(3, (2*0.1)/state.fs, 'highpass')
+        zi = signal.lfilter_zi(iirb, iira)
+        padlen = 3*max(len(iira), len(iirb))
+        if state.margin is None:
+            # samples until the slowest pole has decayed below double precision
+            rho = np.max(np.abs(np.roots(iira)))
+            state.margin = int(np.ceil(np.log(np.finfo(np.float64).eps)/np.log(rho)))
+
+        # forward pass, continued from the last chunk
+        if state.zf is None:
+            if len(amag) <= padlen:
+                raise ValueError(f"the first chunk needs more than {padlen} samples")
+            head = 2*amag[0] - amag[padlen:0:-1]
+            _, state.zf = signal.lfilter(iirb, iira, head, zi=zi*head[0])
+        y, state.zf = signal.lfilter(iirb, iira, amag, zi=state.zf)
+        state.x_tail = np.concatenate([state.x_tail, amag])[-(padlen+1):]
+        state.k_in += len(amag)
+        y = np.concatenate([state.yf, y]) # forward pass of the samples not released yet
+        if time is not None and state.t is not None:
+            time = np.concatenate([state.t, time])
+
+        # backward pass, from the end of the padded stream or margin samples ahead
+        if final:
+            x = state.x_tail
+            tail = 2*x[-1] - x[-2:-(padlen+2):-1]
+            y_tail, _ = signal.lfilter(iirb, iira, tail, zi=state.zf)
+            y_ext = np.concatenate([y, y_tail])
+            n = len(y)
+        else:
+            y_ext = y
+            n = max(len(y) - state.margin, 0)
+            if state.k_in == len(y) and n < 2:
+                n = 0 # lsim needs 2 samples to start
+        if n > 0:
+            u, _ = signal.lfilter(iirb, iira, y_ext[::-1], zi=zi*y_ext[-1])
+            u = u[::-1][:n]
+        else:
+            u = y[:0]
+        state.yf = y[n:]
+
+        # position of proof mass
+        zpos = np.clip(self._proof_mass_chunk(u, state, final), -self.disp_max, self.disp_max)
+
+        # velocity of proof mass, np.gradient over the positions from the last released
+        # sample on, so every released sample has both neighbours (or is an edge of the stream)
+        z = np.concatenate([state.z, zpos])
+        z0 = max(state.k_out-1, 0) # stream index of z[0]
+        end = z0+len(z) if final else z0+len(z)-1
+        if end > state.k_out:
+            # time holds the samples from z0 on
+            zvel = np.gradient(z, state.dt if time is None else time[:len(z)])
+            zvel = zvel[state.k_out-z0:end-z0]
+            time_out = None if time is None else time[state.k_out-z0:end-z0]
+            state.z = z[end-1-z0:]
+            state.t = None if time is None else time[end-1-z0:]
+            state.k_out = end
+        else:
+            zvel = z[:0]
+            time_out = None if time is None else time[:0]
+            state.z = z
+            state.t = time
+
+        damp_power = self.spring_damp * (zvel**2)
+        return time_out, damp_power.astype(self.dtype, copy=False), state
+
+    def energy_chunk(self, time : np.ndarray, power : np.ndarray, state : 'HarvesterState') -> (np.ndarray, 'HarvesterState'):
+        """
+        energy() for a stream processed in consecutive chunks, the running integral
+        is carried in state (float64) so the chunks continue where the last one ended
+
+        time, power:
+            output of power_chunk()
+
+        state:
+            HarvesterState returned by power_chunk() for the same chunk
+
+        returns:
+            energy: numpy array of energy values in Joules since the start of the stream
+            state: HarvesterState to pass with the next chunk
+        """
+        state = state.copy()
+        power = np.asarray(power, dtype=np.float64)
+        if len(power) == 0:
+            return power, state
+        first = state.p_prev is None
+        # trapezoid rule, summed onto the running total so rounding matches a single call
+        y = np.concatenate([[] if first else [state.p_prev], power])
+        if time is None:
+            d = 1/state.fs
+        else:
+            time = np.asarray(time, dtype=np.float64)
+            d = np.diff(np.concatenate([[] if first else [state.t_prev], time]))
+            state.t_prev = time[-1]
+        total = np.cumsum(np.concatenate([[state.e_sum], d * (y[1:] + y[:-1]) / 2.0]))
+        total = total if first else total[1:]
+        state.p_prev = power[-1]
+        state.e_sum = total[-1]
+        return total*self.efficiency, state
+
+    def _proof_mass_chunk(self, u, state, final):
+        # position of the proof mass for the next filtered samples u of a stream, same as
+        # power() would give. lsim continues from the state of the last sample, the fft
+        # engine runs the blocks of _proof_mass_fft once they are complete
+        from scipy import signal
+
+        if self.engine == 'lsim':
+            if len(u) == 0:
+                return u
+            tf = signal.TransferFunction(
+                    [1], 
+                    [1, 
+                     self.spring_damp/self.proof_mass, 
+                     self.spring_const/self.proof_mass])
+            first = state.u_last is None
+            if not first:
+                u = np.concatenate([[state.u_last], u])
+            _, zpos, x = signal.lsim(tf, u, np.arange(len(u))*state.dt, X0=None if first else state.x_lsim)
+            state.u_last, state.x_lsim = u[-1], x[-1]
+            return zpos if first else zpos[1:]
+
+        h, g = self._proof_mass_response(state.dt)
+        block = max(4096, len(h))
+        nfft = 2*block
+        if state.u0 is None and len(u) > 0:
+            state.u0 = u[0]
+        u = np.concatenate([state.blk, u])
+        nblocks = -(-len(u)//block) if final else len(u)//block
+        n = min(len(u), nblocks*block)
+        state.blk = u[n:]
+        if nblocks == 0:
+            return u[:0]
+
+        blocks = np.zeros((nblocks, block))
+        blocks.ravel()[:n] = u[:n]
+        out = np.fft.irfft(np.fft.rfft(blocks, nfft, axis=1)*np.fft.rfft(h, nfft), nfft, axis=1)
+        y = np.zeros(nblocks*block)
+        y += out[:, :block].ravel()
+        if state.carry is not None:
+            y[:block] += state.carry
+        y[block:] += out[:-1, block:].ravel()
+        y = y[:n]
+        state.carry = out[-1, block:]
+
+        k0 = state.n_blocks*block # stream index of y[0]
+        m = min(n, len(g)-k0)
+        if m > 0:
+            y[:m] -= state.u0*g[k0:k0+m]
+        state.n_blocks += nblocks
+        return y
+
+    def _proof_mass_response(self, dt):
+        # impulse response of the proof mass as discretized by lsim (linear
+        # interpolation of the input between samples), cached per parameters and dt
+        key = (self.proof_mass, self.spring_const, self.spring_damp, float(dt))
+        if key in self._response_cache:
+            return self._response_cache[key]
+        from scipy import signal, linalg
+
+        A, B, C, _ = signal.tf2ss([1], [1, self.spring_damp/self.proof_mass, self.spring_const/self.proof_mass])
+        n = A.shape[0]
+        # same matrix exponential as lsim, state is a row vector:
+        # x[i] = x[i-1] @ Ad + u[i-1] * Bd0 + u[i] * Bd1
+        M = np.zeros((n+2, n+2))
+        M[:n, :n] = A*dt
+        M[:n, n:n+1] = B*dt
+        M[n, n+1] = 1
+        expMT = linalg.expm(M.T)
+        Ad = expMT[:n, :n]
+        Bd1 = expMT[n+1:, :n]
+        Bd0 = expMT[n:n+1, :n] - Bd1
+
+        # keep the response until it has decayed to double precision
+        rho = np.max(np.abs(np.linalg.eigvals(Ad)))
+        length = int(np.ceil(np.log(1e-17)/np.log(rho))) + 2 if rho < 1 else 2**16
+
+        # AdC[j] = Ad^j @ C.T
+        AdC = np.empty((length, n))
+        AdC[0] = C[0]
+        for j in range(1, length):
+            AdC[j] = Ad @ AdC[j-1]
+        g = AdC @ Bd1[0] # response to u[i] through Bd1
+        h = g.copy()
+        h[1:] += AdC[:-1] @ Bd0[0] # and to u[i-1] through Bd0
+        self._response_cache[key] = (h, g)
+        return h, g
+
+    def _proof_mass_fft(self, u, dt, block=4096):
+        # lsim(tf, u, time) as a convolution with the impulse response, using FFT
+        # overlap-add over fixed blocks. lsim starts from x[0] = 0 so the first
+        # input only enters through Bd0, remove its Bd1 contribution with g
+        h, g = self._proof_mass_response(dt)
+        u = np.asarray(u, dtype=np.float64)
+        T = len(u)
+        block = max(block, len(h))
+        nfft = 2*block
+        H = np.fft.rfft(h, nfft)
+
+        nblocks = -(-T//block)
+        blocks = np.zeros((nblocks, block))
+        blocks.ravel()[:T] = u
+        out = np.fft.irfft(np.fft.rfft(blocks, nfft, axis=1)*H, nfft, axis=1)
+        y = np.zeros((nblocks+1)*block)
+        y[:nblocks*block] += out[:, :block].ravel()
+        y[block:] += out[:, block:].ravel()
+        y = y[:T]
+
+        n = min(T, len(g))
+        y[:n] -= u[0]*g[:n]
+        return y
+
     def generate_valid_mask(self, energy : np.ndarray, accel_samples : int) -> np.ndarray:
         """
         generates a mask of valid samples based on the energy output of the harvester
@@ -155,6 +494,7 @@ class EnergyHarvester():
     
     @staticmethod
     def get_data_sparsity(valid : np.ndarray) -> float:
+        # for the interval output of sparsify_data use data_utils.interval_sparsity instead
         return np.mean(np.nan_to_num(valid, nan=0))
 
     def _energy_per_packet(self, samples : int) -> float:
@@ -175,3 +515,66 @@ class EnergyHarvester():
         else:
             return 10**-6 * (tx_energy(6 * samples) + acc_energy(samples))
 
+
+
+def _cumtrapz(y, d=None, dx=1.0):
+    # cumulative trapezoid integral with initial=0, same arithmetic as
+    # scipy.integrate.cumtrapz, d is the sample spacing array (or dx if None)
+    d = dx if d is None else d
+    return np.concatenate([[0.0], np.cumsum(d * (y[1:] + y[:-1]) / 2.0)])
+
+
+class HarvesterState():
+    """
+    state of EnergyHarvester.power_chunk() and energy_chunk() between chunks of a
+    stream: the forward filter, the samples held back for the backward pass and the
+    proof mass, the last positions and the running energy integral. Plain attributes
+    so it can be pickled, to_dict() gives a json friendly version
+    """
+
+    # attributes that are float64 arrays (or None)
+    _arrays = ('zf', 'x_tail', 'yf', 'x_lsim', 'blk', 'carry', 'z', 't')
+
+    def __init__(self, fs, dt=None, t0=0.0, margin=None, k_in=0, k_out=0, zf=None, x_tail=None, yf=None,
+                 u_last=None, x_lsim=None, u0=None, n_blocks=0, blk=None, carry=None,
+                 z=None, t=None, p_prev=None, t_prev=None, e_sum=0.0) -> None:
+        self.fs = float(fs)
+        self.dt = 1/self.fs if dt is None else float(dt) # sample spacing of lsim and np.gradient
+        self.t0 = float(t0) # time of the first sample
+        self.margin = margin # samples held back for the backward pass of the high pass
+        self.k_in = k_in # samples passed in
+        self.k_out = k_out # samples released
+        self.zf = zf # forward pass of the high pass
+        self.x_tail = np.zeros(0) if x_tail is None else x_tail # last inputs, to pad the end of the stream
+        self.yf = np.zeros(0) if yf is None else yf # forward pass of the samples held back
+        self.u_last = u_last # lsim: filtered input at the last sample
+        self.x_lsim = x_lsim # lsim: state at the last sample
+        self.u0 = u0 # fft: first filtered input of the stream
+        self.n_blocks = n_blocks # fft: blocks done
+        self.blk = np.zeros(0) if blk is None else blk # fft: filtered inputs of the incomplete block
+        self.carry = carry # fft: overlap of the last block into the next one
+        self.z = np.zeros(0) if z is None else z # positions from the last released sample on
+        self.t = t # time from the last released sample on (None if fs is given)
+        self.p_prev = p_prev
+        self.t_prev = t_prev
+        self.e_sum = e_sum
+        for name in self._arrays:
+            if getattr(self, name) is not None:
+                setattr(self, name, np.asarray(getattr(self, name), dtype=np.float64))
+
+    def copy(self) -> 'HarvesterState':
+        return copy.deepcopy(self)
+
+    def to_dict(self) -> dict:
+        d = dict(self.__dict__)
+        for name in self._arrays:
+            d[name] = None if d[name] is None else d[name].tolist()
+        for name in ('fs', 'dt', 't0', 'u_last', 'u0', 'p_prev', 't_prev', 'e_sum'):
+            d[name] = None if d[name] is None else float(d[name])
+        for name in ('margin', 'k_in', 'k_out', 'n_blocks'):
+            d[name] = None if d[name] is None else int(d[name])
+        return d
+
+    @staticmethod
+    def from_dict(d : dict) -> 'HarvesterState':
+        return HarvesterState(**d)
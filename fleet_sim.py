@@ -0,0 +1,336 @@
+import numpy as np
+
+from data_utils import DeviceState, INIT_OVERHEAD
+
+OFF = DeviceState.OFF.value
+ON_CAN_TX = DeviceState.ON_CAN_TX.value
+ON_CANT_TX = DeviceState.ON_CANT_TX.value
+
+
+class FleetSimulator():
+	"""
+	simulates the energy spending policy of D devices in lockstep, the same state machine as
+	sparsify_data but with the device state, energy and policy variables kept as arrays over
+	devices so every time step is a handful of vectorized numpy operations
+
+	usage example:
+		fleet = FleetSimulator.from_data_windows(data_windows, body_parts, 16, 6e-6, eh)
+		packets = fleet.run()
+		packet_data = fleet.packet_data(acc) # acc is D x T x 3
+
+	packets are written to one columnar output shared by all devices, see run()
+	"""
+
+	def __init__(self,
+				 e_out: np.ndarray,
+				 thresh: float,
+				 packet_size: int,
+				 leakage: float,
+				 policy='opportunistic',
+				 fs=25,
+				 t0=0.0) -> None:
+		"""
+		e_out:
+			D x T cumulative harvested energy of each device in J (EnergyHarvester.energy())
+
+		thresh:
+			energy needed to sample and transmit one packet in J
+
+		packet_size:
+			number of samples in a packet
+
+		leakage:
+			leakage power in W
+
+		policy:
+			'opportunistic', 'dense' or 'conservative_<fraction>', shared by all devices
+
+		fs:
+			sampling rate in Hz
+
+		t0:
+			time of sample 0 in seconds
+		"""
+		self.e_out = np.atleast_2d(np.asarray(e_out, dtype=np.float64))
+		self.D, self.T = self.e_out.shape
+		self.thresh = float(thresh)
+		self.packet_size = packet_size
+		self.LEAKAGE_PER_SAMPLE = leakage*(1/fs)
+		self.policy = policy
+		self.fs = fs
+		self.t0 = t0
+
+		# assume max energy we can store is 3*thresh needed to sample/TX
+		self.MAX_E = INIT_OVERHEAD + self.thresh
+		self.conservative = 'conservative' in policy
+		self.fraction = float(policy.split('_')[1]) if self.conservative else 1
+		self.charge_up_thresh = self.fraction*self.thresh
+		self.alpha = 0.65
+
+		# energy spent during a packet, see _run_policy
+		self.usage_per_packet = 0.0 if policy == 'dense' else self.thresh
+		self.leakage_per_packet = self.LEAKAGE_PER_SAMPLE*packet_size
+
+		# per device state
+		self.state = np.full(self.D, OFF, dtype=np.int8)
+		self.debit = np.zeros(self.D)
+		self.e_prev = np.zeros(self.D)
+		self.e_target = np.full(self.D, self.charge_up_thresh)
+		self.st = np.full(self.D, np.nan)
+		self.en = np.full(self.D, np.nan)
+		self.iat_mu = np.full(self.D, np.nan)
+		self.wt = np.full(self.D, np.nan)
+		self.resume = np.zeros(self.D, dtype=np.int64) # next sample each device makes a decision at
+		self.k = 0
+
+		# per device energy accounting, see PolicyState.accounting()
+		self.restarts = np.zeros(self.D, dtype=np.int64)
+		self.brownouts = np.zeros(self.D, dtype=np.int64)
+		self.n_packets = np.zeros(self.D, dtype=np.int64)
+		self.e_packets = np.zeros(self.D)
+		self.e_clipped = np.zeros(self.D)
+		self.state_samples = np.zeros((self.D, 3), dtype=np.int64) # closed runs per state value
+		self.state_since = np.zeros(self.D, dtype=np.int64)
+
+		# columnar packet output, one chunk per time step with packets
+		self._device = []
+		self._start = []
+		self._end = []
+
+	@classmethod
+	def from_data_windows(cls, data_windows: list, body_parts: list, packet_size: int, leakage: float, eh, policy='opportunistic', fs=None):
+		"""
+		builds a fleet with one device per (data window, body part)
+
+		data_windows:
+			list of (3K+1) x T data windows with time at column 0, same layout as sparsify_data,
+			all of the same length. Device d is body part d % K of window d // K
+
+		fs:
+			sampling rate in Hz, if given the data windows are 3K x T without the time column
+			like sparsify_data(..., fs=fs) and time starts at 0
+		"""
+		import pandas as pd
+
+		e_out = []
+		for data_window in data_windows:
+			for i, bp in enumerate(body_parts):
+				if fs is None:
+					channels = np.array([0,3*i+1,3*i+2,3*i+3])
+					data = pd.DataFrame(data_window[:,channels],columns=['time', 'x', 'y','z'])
+				else:
+					data = np.asarray(data_window[:,3*i:3*i+3], dtype=np.float64)
+				t_out, p_out = eh.power(data, fs=fs)
+				e_out.append(eh.energy(t_out, p_out, fs=fs))
+		if fs is not None:
+			return cls(np.stack(e_out), eh._energy_per_packet(packet_size), packet_size, leakage, policy, fs)
+		data_window = data_windows[0]
+		fs = 1/float(data_window[1,0]-data_window[0,0])
+		return cls(np.stack(e_out), eh._energy_per_packet(packet_size), packet_size, leakage, policy, fs, float(data_window[0,0]))
+
+	def step(self):
+		""" advances every device by one sample """
+		k = self.k
+		ps = self.packet_size
+		L = self.LEAKAGE_PER_SAMPLE
+		MAX_E = self.MAX_E
+		self.k += 1
+
+		# devices in the middle of a packet skip the sample
+		idx = np.nonzero(self.resume <= k)[0]
+		if len(idx) == 0:
+			return
+
+		raw = self.e_out[idx,k]
+		debit = self.debit[idx]
+		state = self.state[idx]
+
+		# house keeping, make sure energy is clipped to bounds
+		e = np.minimum(np.maximum(raw - debit, 0), MAX_E)
+
+		if self.conservative:
+			e_target = np.minimum(self.e_target[idx], MAX_E)
+			on_thresh = 2*L + INIT_OVERHEAD
+			tx_thresh = e_target
+		else:
+			on_thresh = 5*L + INIT_OVERHEAD
+			tx_thresh = self.thresh
+
+		# update state
+		off, can, cant = state == OFF, state == ON_CAN_TX, state == ON_CANT_TX
+		turn_on = off & (e >= on_thresh)
+		debit[turn_on] += INIT_OVERHEAD # apply overhead instantly (from k+1 onwards)
+		state = state.copy()
+		state[turn_on] = ON_CANT_TX
+		state[can & (e == 0)] = OFF
+		state[can & (e != 0) & (e < tx_thresh)] = ON_CANT_TX
+		charged = e >= tx_thresh
+		state[cant & charged] = ON_CAN_TX
+		state[cant & ~charged & (e == 0)] = OFF
+
+		changed = np.nonzero(state != self.state[idx])[0]
+		if len(changed) > 0:
+			c = idx[changed]
+			self.state_samples[c, self.state[c]] += k - self.state_since[c]
+			self.state_since[c] = k
+			self.restarts[c] += turn_on[changed]
+			self.brownouts[c] += state[changed] == OFF
+
+		if self.conservative:
+			st, en, iat_mu, wt = self.st[idx], self.en[idx], self.iat_mu[idx], self.wt[idx]
+			# update state vars while device is on
+			on = state != OFF
+			wt = np.where(on & ~np.isnan(en), k - en, wt)
+			st[~on] = np.nan
+			en[~on] = np.nan
+			iat_mu[~on] = np.nan
+			wt[~on] = np.nan
+			e_target[~on] = self.fraction*self.thresh
+
+		tx = state == ON_CAN_TX
+		if self.conservative and tx.any():
+			# update running mean of iat
+			first = tx & np.isnan(st)
+			second = tx & ~np.isnan(st) & np.isnan(en)
+			later = tx & ~np.isnan(st) & ~np.isnan(en)
+			st[first] = k
+			en[second] = k
+			iat_mu[second] = k - st[second]
+			iat_mu[later] = self.alpha*(k - en[later]) + (1-self.alpha)*iat_mu[later]
+			st[later] = en[later]
+			en[later] = k
+
+		# we are within one packet of the end of the data, the packet is cut off
+		last = tx & (k + ps + 1 >= self.T)
+		self.resume[idx[last]] = self.T
+
+		sent = tx & ~last
+		if sent.any():
+			s = idx[sent]
+			self._device.append(s)
+			self._start.append(np.full(len(s), k))
+			self._end.append(np.full(len(s), k + ps))
+
+			self.n_packets[s] += 1
+			d = debit[sent]
+			seg_last = (self.e_out[s,k+ps] - d) - self.usage_per_packet - self.leakage_per_packet
+			e_next = self.e_out[s,k+ps+1] - d
+			if self.policy == 'dense':
+				surp = e_next - MAX_E
+				over = surp > 0
+				seg_last[over] -= 2*surp[over]
+				d[over] += 2*surp[over]
+				self.e_clipped[s[over]] += 2*surp[over]
+				e_next[over] -= 2*surp[over]
+				d[e_next > 0] += L*ps
+			else:
+				# since the energy is cumulative, subtract thresh from rest of it
+				pos = e_next > 0
+				d[pos] += self.thresh
+				self.e_packets[s[pos]] += self.thresh
+				e_next[pos] -= self.thresh
+				pos = e_next > 0
+				d[pos] += L
+				e_next[pos] -= L
+			debit[sent] = d
+			self.e_prev[s] = seg_last
+			self.resume[s] = k + ps + 1
+
+			if self.conservative:
+				# new target
+				e_target[sent] = np.minimum(e_next + self.charge_up_thresh, MAX_E)
+
+		rest = ~tx
+		if self.conservative:
+			# have enough energy and waited a while, or about to transition to cant zone
+			waiting = rest & (state == ON_CANT_TX) & (e > self.thresh)
+			waited = waiting & ~np.isnan(wt) & (wt > 2*iat_mu)
+			falling = waiting & ~waited & ((e + 5*((e-L)-self.e_prev[idx])) < self.thresh)
+			trigger = waited | falling
+			# e-L, written like the next sample's energy so that a flat harvest triggers
+			e_trigger = np.where(e < MAX_E, raw - (debit + L), e - L)
+			e_target[trigger] = e_trigger[trigger]
+
+		# apply leakage
+		leak = rest & (e > 0)
+		e[leak] -= L
+		debit[leak] += L
+		e = np.minimum(np.maximum(e, 0), MAX_E)
+		self.e_prev[idx[rest]] = e[rest]
+		self.resume[idx[rest]] = k + 1
+
+		self.debit[idx] = debit
+		self.state[idx] = state
+		if self.conservative:
+			self.e_target[idx] = e_target
+			self.st[idx], self.en[idx], self.iat_mu[idx], self.wt[idx] = st, en, iat_mu, wt
+
+	def run(self) -> dict:
+		"""
+		simulates all remaining samples
+
+		returns:
+			packets: dict of equal length arrays, one entry per packet in the order they were sent
+				'device': index of the device that sent it
+				'start', 'end': [start, end) sample interval of the packet data
+				'arrival_time': time the packet arrived in seconds (time of sample end)
+		"""
+		while self.k < self.T:
+			self.step()
+		return self.packets()
+
+	def packets(self) -> dict:
+		""" the columnar packet output of the samples simulated so far """
+		if len(self._device) > 0:
+			self._device = [np.concatenate(self._device)]
+			self._start = [np.concatenate(self._start)]
+			self._end = [np.concatenate(self._end)]
+			device, start, end = self._device[0], self._start[0], self._end[0]
+		else:
+			device = np.zeros(0, dtype=np.int64)
+			start = np.zeros(0, dtype=np.int64)
+			end = np.zeros(0, dtype=np.int64)
+		return {
+			'device': device,
+			'start': start,
+			'end': end,
+			'arrival_time': self.t0 + end/self.fs
+		}
+
+	def accounting(self) -> dict:
+		""" energy accounting of every device for the samples simulated so far, the same
+			entries as PolicyState.accounting() as arrays over devices """
+		k = self.k
+		harvested = self.e_out[:,k-1] if k > 0 else np.zeros(self.D)
+		stored = np.minimum(np.maximum(harvested - self.debit, 0), self.MAX_E)
+		overhead = self.restarts*INIT_OVERHEAD
+		state_samples = self.state_samples.copy()
+		state_samples[np.arange(self.D), self.state] += k - self.state_since
+		return {
+			'harvested': harvested,
+			'stored': stored,
+			'overhead': overhead,
+			'packets': self.e_packets.copy(),
+			'leakage': self.debit - overhead - self.e_packets - self.e_clipped,
+			'clipped': (harvested - self.debit - stored) + self.e_clipped,
+			'n_packets': self.n_packets.copy(),
+			'restarts': self.restarts.copy(),
+			'brownouts': self.brownouts.copy(),
+			'samples_off': state_samples[:,OFF],
+			'samples_on_can_tx': state_samples[:,ON_CAN_TX],
+			'samples_on_cant_tx': state_samples[:,ON_CANT_TX]
+		}
+
+	def packet_data(self, acc: np.ndarray) -> np.ndarray:
+		"""
+		gathers the sampled data of every packet
+
+		acc:
+			D x T x 3 accelerometer data of each device
+
+		returns:
+			P x packet_size x 3 array in the order of packets()
+		"""
+		packets = self.packets()
+		sample_idxs = packets['start'][:,None] + np.arange(self.packet_size)
+		return acc[packets['device'][:,None], sample_idxs]
@@ -1,17 +1,17 @@
 from PyQt5 import QtWidgets
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QHBoxLayout, QVBoxLayout, QCheckBox, QLabel
+from PyQt5.QtWidgets import QFormLayout, QDoubleSpinBox, QSpinBox, QComboBox
 from PyQt5.QtGui import QPalette, QColor, QFont
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QObject, pyqtSignal
 import pyqtgraph as pg
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from time import perf_counter
 
-from energy_harvest import EnergyHarvester
 from data_utils import *
 
-import pickle
 
 # ====================== global settings ======================
 pg.setConfigOptions(antialias=True, background="w", foreground="k")
@@ -29,9 +29,70 @@ class Color(QWidget):
 		self.setPalette(palette)
 
 
+# ====================== decimation ======================
+def envelope(x, step):
+	""" min and max of every step samples (along the last axis) interleaved, so a decimated
+		curve still shows the peaks """
+	if step <= 1:
+		return x
+	n = x.shape[-1]//step*step
+	x = np.asarray(x[...,:n]).reshape(*x.shape[:-1], -1, step)
+	return np.stack([x.min(axis=-1), x.max(axis=-1)], axis=-1).reshape(*x.shape[:-2], -1)
+
+
+# ====================== simulation worker ======================
+class SimulationWorker(QObject):
+	""" Runs an IncrementalSimulation off the UI thread. Results are emitted per body part
+		(through a queued signal so the slot runs on the UI thread) as soon as they are ready,
+		a newer request makes the remaining body parts of an older one stale. The snapshots
+		for seeking (a SeekableSimulation) are taken on a second thread so they do not hold
+		up the next request """
+
+	result = pyqtSignal(int, str, object) # generation, body part, (packets, trace)
+	seekable_ready = pyqtSignal(int, object) # generation, SeekableSimulation
+
+	def __init__(self, simulation):
+		super(SimulationWorker, self).__init__()
+		self.simulation = simulation
+		self.executor = ThreadPoolExecutor(max_workers=1)
+		self.seek_executor = ThreadPoolExecutor(max_workers=1)
+		self.generation = 0
+
+	def submit(self, params, body_parts, simulation=None):
+		""" simulation replaces the one results are computed with, e.g. after switching streams """
+		if simulation is not None:
+			self.simulation = simulation
+		self.generation += 1
+		self.executor.submit(self._run, self.generation, self.simulation, dict(params), list(body_parts))
+		return self.generation
+
+	def _run(self, generation, simulation, params, body_parts):
+		for bp in body_parts:
+			if generation != self.generation:
+				return
+			self.result.emit(generation, bp, simulation.run_body_part(bp, **params))
+
+	def submit_seekable(self, params):
+		""" snapshots of the stream with the parameters of the last request """
+		self.seek_executor.submit(self._run_seekable, self.generation, self.simulation, dict(params))
+
+	def _run_seekable(self, generation, simulation, params):
+		if generation != self.generation:
+			return
+		seekable = simulation.seekable(**params)
+		seekable.run()
+		if generation == self.generation:
+			self.seekable_ready.emit(generation, seekable)
+
+	def shutdown(self):
+		self.generation += 1
+		self.executor.shutdown(wait=False)
+		self.seek_executor.shutdown(wait=False)
+
+
 # ====================== maingui class ======================
 class IoTDIDemo(QMainWindow):
-	def __init__(self, body_parts, title, label_map, label_stream, data_stream, time_ax, data_packets, e_plots,thresh):
+	def __init__(self, body_parts, title, label_map, label_stream, data_stream, time_ax, data_packets, e_plots,thresh,simulation=None,params=None,library=None,stream_name=None):
 		super(IoTDIDemo, self).__init__()
 		
 		self.title = title
@@ -44,6 +105,24 @@ class IoTDIDemo(QMainWindow):
 		self.e_plots = e_plots
 		self.thresh = thresh
 
+		# parameters the packets and e_plots were simulated with, editable in the parameter
+		# panel if an IncrementalSimulation is given
+		self.simulation = simulation
+		self.params = {'efficiency': 0.3, 'leakage': 6e-6, 'packet_size': 16, 'policy': 'opportunistic'}
+		if params is not None:
+			self.params.update(params)
+		self.packet_size = self.params['packet_size']
+
+		# streams that can be switched to from the GUI (a StreamLibrary), the simulation of
+		# each stream is kept with it so switching back does not simulate again
+		self.library = library
+		self.stream_name = stream_name
+		if library is not None and simulation is None:
+			self.simulation = library.open(stream_name).simulation
+		# snapshots of the current results, scrolling simulates the window again from the
+		# nearest one (see update_scroll), None until they are taken
+		self.seekable = None
+
 		self.initUI()
 
 	def initUI(self):
@@ -101,6 +180,20 @@ class IoTDIDemo(QMainWindow):
 		self.timer.timeout.connect(self.time_update)
 		self.left_empty_pane.addWidget(self.sbutton)
 		self.left_empty_pane.addWidget(self.ebutton)
+
+		# playback speed, faster playback shows a longer window (decimated to max_points per
+		# curve) and the position follows the clock so slow frames are skipped, not queued
+		self.speed = 1.0
+		self.max_points = 2000
+		self.speed_box = QComboBox()
+		self.speed_box.addItems(['1x','2x','5x','10x','25x','50x','100x','250x','1000x'])
+		self.speed_box.currentTextChanged.connect(self.set_speed)
+		self.left_empty_pane.addWidget(QLabel("Playback speed"))
+		self.left_empty_pane.addWidget(self.speed_box)
+		if self.library is not None:
+			self.init_stream_selector()
+		if self.simulation is not None:
+			self.init_parameter_panel()
 		self.start_time = 0
 		self.left_vertical_pane.addLayout(self.checkbox_pane)
 		self.left_vertical_pane.addLayout(self.left_empty_pane)
@@ -123,9 +216,7 @@ class IoTDIDemo(QMainWindow):
 		self.label_stream_widget.getViewBox().setLimits(yMin=range_[1][0], yMax=range_[1][1], minYRange = range_[1][1]-range_[1][0])  
 
 
-		self.transitions = [i for i in range(1, len(self.label_stream)) if self.label_stream[i] != self.label_stream[i - 1]]
-		self.transitions.insert(0,0)
-		self.transitions = np.array(self.transitions)/self.fs
+		self.transitions = label_segments(self.label_stream)[0]/self.fs
   
 		self.scroll_widget = QtWidgets.QScrollBar(Qt.Horizontal)
 		self.scroll_widget.setMinimum(self.plot_window_width)
@@ -133,17 +224,6 @@ class IoTDIDemo(QMainWindow):
 		self.scroll_widget.setValue(self.plot_window_width)
 		self.scroll_widget.valueChanged.connect(self.update_scroll)
 
-		# find nearest transition
-		candidates = (self.transitions <= self.scroll_widget.value()) & (self.transitions >= (self.scroll_widget.value()-self.plot_window_width))
-		candidate = candidates.nonzero()[0]
-		if len(candidate) > 0:
-			candidate = candidate[0]
-			txt = self.label_map[self.label_stream[int(candidate+1)*self.fs]]
-			self.text = pg.TextItem(txt,color='black',anchor=(0,0))
-			self.text.setPos(candidate, self.label_stream[int(candidate+1)*self.fs]+4)
-			self.text.setParentItem(self.label_stream_widget_curve)
-			self.text.setFont(self.my_font)
-
 		# right side of GUI
 		self.label_scroll_pane.addWidget(self.label_stream_widget)
 		self.label_scroll_pane.addWidget(self.scroll_widget)
@@ -168,10 +248,11 @@ class IoTDIDemo(QMainWindow):
 		self.elapsed = 0
 		self.pause_time = 0
 		self.pause_elapsed = 0
-		self.seen_candidates = [candidate]
-		self.seen_packet_candidates = []
-
-		self.packet_regions = {bp: {} for bp_i, bp in enumerate(self.body_parts)}
+		# only the annotations around the visible window are kept, see update_label_texts()
+		# and update_packet_regions()
+		self.label_texts = {} # transition time -> TextItem
+		self.packet_regions = {bp: {} for bp_i, bp in enumerate(self.body_parts)} # arrival time -> LinearRegionItem
+		self.packet_bars = {} # per body part one BarGraphItem of all packets in a long window
 
 		self.last_was_time = False
 		self.last_was_scroll = False
@@ -182,6 +263,257 @@ class IoTDIDemo(QMainWindow):
 		self.global_xmax = self.plot_window_width
 		self.last_val = self.plot_window_width
 
+		self.update_label_texts(0, self.plot_window_width)
+
+
+	def init_stream_selector(self):
+		self.stream_box = QComboBox()
+		self.stream_box.addItems(self.library.names())
+		self.stream_box.setCurrentText(self.stream_name)
+		self.stream_box.currentTextChanged.connect(self.set_stream)
+		self.left_empty_pane.addWidget(QLabel("Stream"))
+		self.left_empty_pane.addWidget(self.stream_box)
+
+	def init_parameter_panel(self):
+		self.parameter_pane = QFormLayout()
+
+		self.efficiency_box = QDoubleSpinBox()
+		self.efficiency_box.setRange(0.01, 1.0)
+		self.efficiency_box.setSingleStep(0.05)
+		self.efficiency_box.setValue(self.params['efficiency'])
+
+		self.leakage_box = QDoubleSpinBox() # in uW
+		self.leakage_box.setRange(0.0, 100.0)
+		self.leakage_box.setSingleStep(1.0)
+		self.leakage_box.setValue(self.params['leakage']*1e6)
+
+		self.packet_size_box = QSpinBox()
+		self.packet_size_box.setRange(1, 256)
+		self.packet_size_box.setValue(self.params['packet_size'])
+
+		self.policy_box = QComboBox()
+		self.policy_box.addItems(['opportunistic','conservative_1.2','conservative_1.5','dense'])
+		self.policy_box.setCurrentText(self.params['policy'])
+
+		self.parameter_pane.addRow("Efficiency", self.efficiency_box)
+		self.parameter_pane.addRow("Leakage (uW)", self.leakage_box)
+		self.parameter_pane.addRow("Packet size", self.packet_size_box)
+		self.parameter_pane.addRow("Policy", self.policy_box)
+		self.simulation_status = QLabel("")
+		self.parameter_pane.addRow(self.simulation_status)
+		self.left_empty_pane.addLayout(self.parameter_pane)
+
+		# wait for the user to stop typing/scrolling before simulating
+		self.parameter_timer = pg.QtCore.QTimer()
+		self.parameter_timer.setSingleShot(True)
+		self.parameter_timer.timeout.connect(self.recompute)
+		for box in [self.efficiency_box, self.leakage_box, self.packet_size_box]:
+			box.valueChanged.connect(lambda _: self.parameter_timer.start(200))
+		self.policy_box.currentTextChanged.connect(lambda _: self.parameter_timer.start(200))
+
+		self.worker = SimulationWorker(self.simulation)
+		self.worker.result.connect(self.simulation_done)
+		self.worker.seekable_ready.connect(self.seekable_done)
+		self.pending = set()
+		self.generation = self.worker.generation
+		self.worker.submit_seekable(self.params)
+
+	def recompute(self):
+		params = {
+			'efficiency': round(self.efficiency_box.value(), 4),
+			'leakage': round(self.leakage_box.value(), 4)*1e-6,
+			'packet_size': self.packet_size_box.value(),
+			'policy': self.policy_box.currentText()
+		}
+		if params == self.params:
+			return
+		self.params = params
+		self.submit_simulation()
+
+	def submit_simulation(self):
+		# visible body parts first
+		body_parts = sorted(self.body_parts, key=lambda bp: not self.checkboxes[bp].isChecked())
+		self.pending = set(body_parts)
+		self.recompute_start = perf_counter()
+		self.simulation_status.setText("simulating...")
+		self.seekable = None
+		self.generation = self.worker.submit(self.params, body_parts, self.simulation)
+
+	def set_stream(self, name):
+		""" switches to another stream of the library. The streams are memory mapped so the
+			labels and accelerometer data show right away, the energy and packets follow when
+			the simulation is done (instantly if the stream was simulated with these parameters
+			before and is still open in the library) """
+		if name == self.stream_name:
+			return
+		if self.timer.isActive():
+			self.stop()
+		stream = self.library.open(name)
+		self.stream_name = name
+		self.label_stream = stream.labels
+		self.data_stream = stream.data
+		self.time_ax = stream.time_ax
+		self.transitions = stream.transitions
+		self.simulation = stream.simulation
+		self.seekable = None
+
+		# drop the annotations of the old stream
+		self.update_label_texts(np.inf, np.inf)
+		self.update_packet_regions(np.inf, np.inf)
+		self.update_packet_bars(np.inf, np.inf)
+
+		# no packets and no energy until the simulation is done
+		for bp in self.body_parts:
+			self.data_packets[bp] = (np.zeros(0), np.zeros((0,self.packet_size,3)))
+			self.e_plots[bp] = np.broadcast_to(0.0, (len(self.time_ax),))
+
+		# back to the start of the stream
+		self.first_time = 0
+		self.pause_time = 0
+		self.pause_elapsed = 0
+		self.last_was_time = False
+		self.global_xmax = self.plot_window_width
+		self.last_val = self.plot_window_width
+		self.scroll_widget.blockSignals(True)
+		self.scroll_widget.setMaximum(len(self.time_ax)//self.fs)
+		self.scroll_widget.setValue(self.plot_window_width)
+		self.scroll_widget.blockSignals(False)
+		self.update_scroll()
+
+		self.submit_simulation()
+
+	def simulation_done(self, generation, bp, result):
+		if generation != self.generation:
+			return
+		self.data_packets[bp], self.e_plots[bp] = result
+		self.thresh = self.e_plots[bp].thresh
+		self.packet_size = self.params['packet_size']
+		if bp in self.checked:
+			self.redraw_body_part(bp)
+		self.pending.discard(bp)
+		if len(self.pending) == 0:
+			self.simulation_status.setText(f"done in {perf_counter()-self.recompute_start:.2f} s")
+			self.worker.submit_seekable(self.params)
+
+	def seekable_done(self, generation, seekable):
+		if generation == self.generation:
+			self.seekable = seekable
+
+	def current_window(self):
+		xmax = self.global_xmax if self.last_was_time else self.scroll_widget.value()
+		if self.timer.isActive():
+			xmax = min(self.global_xmax + (perf_counter() - self.clicked_start)*self.speed, len(self.time_ax)/self.fs)
+			return xmax-self.playback_width(), xmax
+		return xmax-self.plot_window_width, xmax
+
+	def playback_width(self):
+		""" seconds shown while playing, longer at high speeds so the data stays readable """
+		return self.plot_window_width*max(1.0, self.speed/10)
+
+	def set_speed(self, text):
+		if self.timer.isActive():
+			# continue from where the window is now
+			self.global_xmax = self.current_window()[1]
+			self.clicked_start = perf_counter()
+		self.speed = float(text.rstrip('x'))
+
+	def redraw_body_part(self, bp):
+		""" replaces the energy curve and packet regions of a visible body part with new results """
+		pw, _, pw2, curve = self.plot_widgets[bp]
+		pw2.setYRange(0-1e-5, INIT_OVERHEAD+self.thresh+1e-5)
+
+		# the packet regions of the old results
+		for pack in self.packet_regions[bp].values():
+			pw.removeItem(pack)
+		self.packet_regions[bp] = {}
+		self.draw_window(*self.current_window())
+
+	def draw_window(self, xmin, xmax, e_window=None):
+		""" draws [xmin, xmax] on all plots from the same sample range so they stay in sync.
+			Windows longer than max_points are decimated and their packets are drawn as one
+			batched item per body part instead of a region per packet. e_window is the stored
+			energy of the window per body part if it was simulated already, see update_scroll() """
+		start, end = max(int(xmin*self.fs), 0), max(int(xmax*self.fs), 0)
+		step = -(-(end-start)//(self.max_points//2)) # min and max per step samples
+		time_data = self.time_ax[start:end]
+		if step > 1:
+			time_data = np.repeat(time_data[:(end-start)//step*step:step], 2)
+		self.label_stream_widget_curve.setData(time_data,envelope(self.label_stream[start:end], step))
+		for bp_i, bp in enumerate(self.body_parts):
+			# add to checked if not already checked
+			if self.checkboxes[bp].isChecked():
+				acc = envelope(self.data_stream[bp_i*3:bp_i*3+3,start:end], step)
+				for i in range(3):
+					self.plot_widgets[bp][1][i].setData(time_data,acc[i])
+				e = self.e_plots[bp][start:end] if e_window is None else e_window[bp]
+				self.plot_widgets[bp][3].setData(time_data,envelope(e, step))
+
+		# find nearest transition
+		self.update_label_texts(xmin, xmax)
+
+		# find nearest packet
+		if xmax-xmin > self.plot_window_width:
+			self.update_packet_regions(np.inf, np.inf)
+			self.update_packet_bars(xmin, xmax)
+		else:
+			self.update_packet_bars(np.inf, np.inf)
+			self.update_packet_regions(xmin, xmax)
+
+	def update_label_texts(self, xmin, xmax):
+		""" shows the label name at each transition in [xmin, xmax]. Names further than a
+			window away are removed so long sessions do not pile up TextItems """
+		margin = self.plot_window_width
+		for candidate in [c for c in self.label_texts if c < xmin-margin or c > xmax+margin]:
+			text = self.label_texts.pop(candidate)
+			text.setParentItem(None)
+			if text.scene() is not None:
+				text.scene().removeItem(text)
+
+		start, end = np.searchsorted(self.transitions, xmin, side='left'), np.searchsorted(self.transitions, xmax, side='right')
+		for candidate in self.transitions[start:end]:
+			if candidate in self.label_texts:
+				continue
+			label = self.label_stream[min(int(candidate+1)*self.fs, len(self.label_stream)-1)]
+			text = pg.TextItem(self.label_map[label],color='black',anchor=(0,0))
+			text.setPos(candidate, label+4)
+			text.setParentItem(self.label_stream_widget_curve)
+			text.setFont(self.my_font)
+			self.label_texts[candidate] = text
+
+	def update_packet_regions(self, xmin, xmax, body_parts=None):
+		""" shades the packets that arrive in [xmin, xmax] on the plots of the checked body
+			parts (or the given ones) and removes the ones that left the window """
+		for bp in self.checked if body_parts is None else body_parts:
+			pw = self.plot_widgets[bp][0]
+			regions = self.packet_regions[bp]
+			for packet_candidate in [pc for pc in regions if pc < xmin or pc > xmax]:
+				pw.removeItem(regions.pop(packet_candidate))
+
+			all_ats = np.asarray(self.data_packets[bp][0]).reshape(-1)
+			start, end = np.searchsorted(all_ats, xmin, side='left'), np.searchsorted(all_ats, xmax, side='right')
+			for packet_candidate in all_ats[start:end]:
+				if packet_candidate in regions:
+					if packet_candidate-self.packet_size/self.fs < xmin:
+						regions[packet_candidate].setRegion([xmin,packet_candidate])
+				else:
+					pack = pg.LinearRegionItem([packet_candidate-self.packet_size/self.fs,packet_candidate],movable=False,brush=(0, 0, 0, 50))
+					pw.addItem(pack)
+					regions[packet_candidate] = pack
+
+	def update_packet_bars(self, xmin, xmax):
+		""" all packets of a checked body part that arrive in [xmin, xmax] as one BarGraphItem,
+			updated once per frame """
+		for bp in self.checked:
+			all_ats = np.asarray(self.data_packets[bp][0]).reshape(-1)
+			start, end = np.searchsorted(all_ats, xmin, side='left'), np.searchsorted(all_ats, xmax, side='right')
+			ats = all_ats[start:end]
+			if bp not in self.packet_bars:
+				if len(ats) == 0:
+					continue
+				self.packet_bars[bp] = pg.BarGraphItem(x0=ats-self.packet_size/self.fs, x1=ats, y0=-20, y1=20, brush=(0, 0, 0, 50), pen=None)
+				self.plot_widgets[bp][0].addItem(self.packet_bars[bp])
+			else:
+				self.packet_bars[bp].setOpts(x0=ats-self.packet_size/self.fs, x1=ats)
 
 	def update_plot_layout(self):
 		val = self.scroll_widget.value()
@@ -212,7 +544,8 @@ class IoTDIDemo(QMainWindow):
 
 				# energy axis
 				pw2 = pg.ViewBox()
-				pw2.setYRange(min(self.e_plots[bp])-1e-5, max(self.e_plots[bp])+1e-5)
+				# stored energy is within [0, MAX_E], no need to scan the whole trace
+				pw2.setYRange(0-1e-5, INIT_OVERHEAD+self.thresh+1e-5)
 				pw.plotItem.showAxis('right')
 				pw.plotItem.scene().addItem(pw2)
 				pw.plotItem.getAxis('right').linkToView(pw2)
@@ -236,47 +569,14 @@ class IoTDIDemo(QMainWindow):
 				self.checked.remove(bp)
 				self.plot_pane.removeWidget(self.plot_widgets[bp][0])
 				self.plot_widgets[bp][0].deleteLater()
+				self.packet_regions[bp] = {}
+				self.packet_bars.pop(bp, None)
 				print("unclicked", bp)
 
 
 		# find nearest packet
 		print("updating lr",clicked_bp)
-		all_ats = self.data_packets[clicked_bp][0]
-		packet_candidates = (all_ats <= xmax) & (all_ats >= xmin)
-		packet_candidates = packet_candidates.nonzero()[0]
-		if len(packet_candidates) > 0:
-			print(packet_candidates)
-			for c in packet_candidates:
-				packet_candidate = all_ats[c]
-				if (packet_candidate,clicked_bp) in self.seen_packet_candidates:
-					print("seen")
-					if packet_candidate-16/self.fs < xmin:
-						self.packet_regions[clicked_bp][packet_candidate].setRegion([xmin,packet_candidate])
-					elif packet_candidate > xmax and packet_candidate-self.fs < xmax:
-						self.packet_regions[clicked_bp][packet_candidate].setRegion([packet_candidate,xmax])
-				else:
-					# print("new packet:", packet_candidate, "bp: ", bp)
-					
-					self.seen_packet_candidates.append((packet_candidate,clicked_bp))
-					pack = pg.LinearRegionItem([packet_candidate-16/self.fs,packet_candidate],movable=False,brush=(0, 0, 0, 50))
-					if self.checkboxes[clicked_bp].isChecked():
-						self.plot_widgets[clicked_bp][0].addItem(pack)
-					self.packet_regions[clicked_bp][packet_candidate] = pack
-
-		to_remove = []
-		for pc in self.seen_packet_candidates:
-			if self.checkboxes[pc[1]].isChecked():
-				if pc[0] < xmin or pc[0] > xmax:
-					# print("delete", pc,self.packet_regions[pc[1]][pc[0]])
-					try:
-						self.plot_widgets[pc[1]][0].removeItem(self.packet_regions[pc[1]][pc[0]])
-					except:
-						print("===========",pc)
-						print(self.plot_widgets[pc[1]])
-						exit()
-					to_remove.append(pc)
-		for pc in to_remove:
-			self.seen_packet_candidates.remove(pc)
+		self.update_packet_regions(xmin, xmax)
 
 	def update_views(self):
 		for bp_i, bp in enumerate(self.body_parts):
@@ -308,149 +608,27 @@ class IoTDIDemo(QMainWindow):
 		self.last_was_scroll = True
 		xmin = xmax - self.plot_window_width
 
-		# print(xmin,xmax,val,self.elapsed)
-		
-		time_data = self.time_ax[int(xmin*self.fs):int(xmax*self.fs)]
-		self.label_stream_widget_curve.setData(time_data,self.label_stream[int(xmin*self.fs):int(xmax*self.fs)])
-		for bp_i, bp in enumerate(self.body_parts):
-			# add to checked if not already checked
-			if self.checkboxes[bp].isChecked():
-				for i in range(3):
-					self.plot_widgets[bp][1][i].setData(time_data,self.data_stream[bp_i*3+i,int(xmin*self.fs):int(xmax*self.fs)])
-				self.plot_widgets[bp][3].setData(time_data,self.e_plots[bp][int(xmin*self.fs):int(xmax*self.fs)])
-		
-		# find nearest transition
-		candidates = (self.transitions <= xmax) & (self.transitions >= xmin)
-		candidates = candidates.nonzero()[0]
-		if len(candidates) > 0:
-			for c in candidates:
-				candidate = self.transitions[c]
-				candidate = self.transitions[c]
-				if candidate in self.seen_candidates:
-					continue
-				else:
-					# print("new:", candidate)
-					self.seen_candidates.append(candidate)
-				txt = self.label_map[self.label_stream[int(candidate+1)*self.fs]]
-				text = pg.TextItem(txt,color='black',anchor=(0,0))
-				text.setPos(candidate, self.label_stream[int(candidate+1)*self.fs]+4)
-				text.setParentItem(self.label_stream_widget_curve)
-				text.setFont(self.my_font)
+		# seeking simulates the window again from the nearest snapshot
+		e_window = None
+		if self.seekable is not None:
+			_, e_window, _ = self.seekable.window(max(int(xmin*self.fs), 0), max(int(xmax*self.fs), 0))
 
-		# find nearest packet
-		for bp_i, bp in enumerate(self.body_parts):
-			if self.checkboxes[bp].isChecked():
-				all_ats = self.data_packets[bp][0]
-				packet_candidates = (all_ats <= xmax) & (all_ats >= xmin)
-				packet_candidates = packet_candidates.nonzero()[0]
-				if len(packet_candidates) > 0:
-					for c in packet_candidates:
-						packet_candidate = all_ats[c]
-						if (packet_candidate,bp) in self.seen_packet_candidates:
-							if packet_candidate-16/self.fs < xmin:
-								self.packet_regions[bp][packet_candidate].setRegion([xmin,packet_candidate])
-							elif packet_candidate > xmax and packet_candidate-self.fs < xmax:
-								self.packet_regions[bp][packet_candidate].setRegion([packet_candidate,xmax])
-						else:
-							# print("new packet:", packet_candidate, "bp: ", bp)
-							
-							self.seen_packet_candidates.append((packet_candidate,bp))
-							pack = pg.LinearRegionItem([packet_candidate-16/self.fs,packet_candidate],movable=False,brush=(0, 0, 0, 50))
-							if self.checkboxes[bp].isChecked():
-								self.plot_widgets[bp][0].addItem(pack)
-							self.packet_regions[bp][packet_candidate] = pack
-
-		to_remove = []
-		for pc in self.seen_packet_candidates:
-			if self.checkboxes[pc[1]].isChecked():
-				if pc[0] < xmin or pc[0] > xmax:
-					# print("delete", pc,self.packet_regions[pc[1]][pc[0]])
-					try:
-						self.plot_widgets[pc[1]][0].removeItem(self.packet_regions[pc[1]][pc[0]])
-					except:
-						print("===========",pc)
-						print(self.plot_widgets[pc[1]])
-						exit()
-					to_remove.append(pc)
-		for pc in to_remove:
-			self.seen_packet_candidates.remove(pc)
+		# print(xmin,xmax,val,self.elapsed)
+		self.draw_window(xmin, xmax, e_window)
 
 		self.last_val = val
 
 
 	def time_update(self):
-		# get the current time
-		now = perf_counter()
-  
-		xmax = self.global_xmax + (now - self.clicked_start)
+		# the window follows the clock (times the speed), a frame that took long is not
+		# caught up on, the next one just jumps ahead
+		xmin, xmax = self.current_window()
 		self.last_was_time = True
+		self.draw_window(xmin, xmax)
 
-		xmin = xmax - self.plot_window_width
-		
-		time_data = self.time_ax[int(xmin*self.fs):int(xmax*self.fs)]
-		self.label_stream_widget_curve.setData(time_data,self.label_stream[int(xmin*self.fs):int(xmax*self.fs)])
-		
-		for bp_i, bp in enumerate(self.body_parts):
-			# add to checked if not already checked
-			if self.checkboxes[bp].isChecked():
-				for i in range(3):
-					self.plot_widgets[bp][1][i].setData(time_data,self.data_stream[bp_i*3+i,int(xmin*self.fs):int(xmax*self.fs)])
-				self.plot_widgets[bp][3].setData(time_data,self.e_plots[bp][int(xmin*self.fs):int(xmax*self.fs)])
-		# find nearest transition
-		candidates = (self.transitions <= xmax) & (self.transitions >= xmin)
-		candidates = candidates.nonzero()[0]
-		if len(candidates) > 0:
-			for c in candidates:
-				candidate = self.transitions[c]
-				candidate = self.transitions[c]
-				if candidate in self.seen_candidates:
-					continue
-				else:
-					# print("new:", candidate)
-					self.seen_candidates.append(candidate)
-				txt = self.label_map[self.label_stream[int(candidate+1)*self.fs]]
-				text = pg.TextItem(txt,color='black',anchor=(0,0))
-				text.setPos(candidate, self.label_stream[int(candidate+1)*self.fs]+4)
-				text.setParentItem(self.label_stream_widget_curve)
-				text.setFont(self.my_font)
-
-		# find nearest packet
-		for bp_i, bp in enumerate(self.body_parts):
-			if self.checkboxes[bp].isChecked():
-				all_ats = self.data_packets[bp][0]
-				packet_candidates = (all_ats <= xmax) & (all_ats >= xmin)
-				packet_candidates = packet_candidates.nonzero()[0]
-				if len(packet_candidates) > 0:
-					for c in packet_candidates:
-						packet_candidate = all_ats[c]
-						if (packet_candidate,bp) in self.seen_packet_candidates:
-							if packet_candidate-16/self.fs < xmin:
-								self.packet_regions[bp][packet_candidate].setRegion([xmin,packet_candidate])
-							elif packet_candidate > xmax and packet_candidate-self.fs < xmax:
-								self.packet_regions[bp][packet_candidate].setRegion([packet_candidate,xmax])
-						else:
-							# print("new packet:", packet_candidate, "bp: ", bp)
-							
-							self.seen_packet_candidates.append((packet_candidate,bp))
-							pack = pg.LinearRegionItem([packet_candidate-16/self.fs,packet_candidate],movable=False,brush=(0, 0, 0, 50))
-							if self.checkboxes[bp].isChecked():
-								self.plot_widgets[bp][0].addItem(pack)
-							self.packet_regions[bp][packet_candidate] = pack
-
-		to_remove = []
-		for pc in self.seen_packet_candidates:
-			if self.checkboxes[pc[1]].isChecked():
-				if pc[0] < xmin or pc[0] > xmax:
-					# print("delete", pc,self.packet_regions[pc[1]][pc[0]])
-					try:
-						self.plot_widgets[pc[1]][0].removeItem(self.packet_regions[pc[1]][pc[0]])
-					except:
-						print("===========",pc)
-						print(self.plot_widgets[pc[1]])
-						exit()
-					to_remove.append(pc)
-		for pc in to_remove:
-			self.seen_packet_candidates.remove(pc)
+		# end of the stream
+		if xmax >= len(self.time_ax)/self.fs:
+			self.stop()
 
 
 	def start(self):
@@ -477,10 +655,15 @@ class IoTDIDemo(QMainWindow):
 		self.pause_time = perf_counter()
 		# print(self.scroll_widget.value(),self.elapsed/self.fs)
 		self.clicked_stop = perf_counter()
-		self.global_xmax += (self.clicked_stop - self.clicked_start)
+		self.global_xmax = min(self.global_xmax + (self.clicked_stop - self.clicked_start)*self.speed, len(self.time_ax)/self.fs)
+		if self.speed > 10:
+			# back to the normal window
+			self.draw_window(self.global_xmax-self.plot_window_width, self.global_xmax)
 
 	def closeEvent(self, event):
 		self.timer.stop()
+		if self.simulation is not None:
+			self.worker.shutdown()
 		event.accept()
 
 	def prepare_data(self):
@@ -517,15 +700,6 @@ if __name__ == '__main__':
 			 18:'playing basketball'
 			 }
 	
-	label_stream = np.load('data_streams/val_labels.npy')
-	data_stream = np.load('data_streams/val_data.npy')
-	# time_ax = np.linspace(0,int(len(label_stream)/self.fs),len(label_stream))
-	time_ax = np.arange(len(label_stream))/25
-	t_axis = np.expand_dims(time_ax,axis=0)
-
-	# add the time axis to the data
-	full_data_window = np.concatenate([t_axis,data_stream],axis=0).T
-
 	# energy harvesting parameters
 	eh_params = {
 		'proof_mass': 1*(10**-3),
@@ -534,28 +708,20 @@ if __name__ == '__main__':
 		'disp_max': 0.01,
 		'efficiency':0.3
 	}
-	eh = EnergyHarvester(**eh_params)
-
-	# data_packets, e_plots, thresh = sparsify_data(full_data_window,body_parts,16,6e-6,eh,'opportunistic',visualize=True)
-	# with open('packets.pickle', 'wb') as handle:
-	# 	pickle.dump(data_packets, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-	# with open('e_plots.pickle', 'wb') as handle:
-	# 	pickle.dump(e_plots, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-	# with open('thresh.pickle', 'wb') as handle:
-	# 	pickle.dump(thresh, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-	with open('packets.pickle', 'rb') as handle:
-		data_packets = pickle.load(handle)
+	# the streams are uniformly sampled at 25 Hz, no need to add a time column to the data
+	# data_packets, e_plots, thresh = sparsify_data(data_stream.T,body_parts,16,6e-6,EnergyHarvester(**eh_params),'opportunistic',visualize=True,fs=25)
 
-	with open('e_plots.pickle', 'rb') as handle:
-		e_plots = pickle.load(handle)
+	# the streams in data_streams/ (val, testing, ...) are memory mapped when first shown and
+	# the last few stay open with their simulations, see StreamLibrary
+	library = StreamLibrary('data_streams', body_parts, eh_params, fs=25)
+	stream = library.open('val')
 
-	with open('thresh.pickle', 'rb') as handle:
-		thresh = pickle.load(handle)
+	# simulate in stages so the parameter panel only re-runs what a change affects,
+	# e_plots are compact energy traces (EnergyTrace) that the GUI slices like arrays
+	params = {'efficiency': eh_params['efficiency'], 'leakage': 6e-6, 'packet_size': 16, 'policy': 'opportunistic'}
+	data_packets, e_plots, thresh = stream.simulation.run(**params)
 
-	win = IoTDIDemo(body_parts, title, label_map, label_stream, data_stream, time_ax, data_packets, e_plots, thresh)
+	win = IoTDIDemo(body_parts, title, label_map, stream.labels, stream.data, stream.time_ax, data_packets, e_plots, thresh, stream.simulation, params, library, 'val')
 
 	win.show()
 	sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,184 @@
+import numpy as np
+import pickle
+
+from data_utils import packet_features, feature_names
+
+# default resolution of the int16 codec in m/s^2 per LSB, +-128 m/s^2 (~13 g) range
+DEFAULT_SCALE = 1/256
+
+
+def save_packets(path: str,packets: dict,fs: float=25,codec: str=None,scale: float=DEFAULT_SCALE,features=None):
+	""" Saves the packets of sparsify_data to an .npz packet store
+
+	Parameters
+	----------
+
+	path: str
+		file to write, '.npz' is appended by numpy if missing
+
+	packets: dict
+		per body part a tuple (arrival_times, packet_data) as returned by sparsify_data
+
+	fs: float
+		sampling rate of the stream in Hz, stored next to the packets
+
+	codec: str
+		None to store the packets as they are, 'int16' to store them with encode_packets()
+		in a compressed store (about 6 bytes per 3-axis sample before compression)
+
+	scale: float
+		resolution of the 'int16' codec
+
+	features: tuple
+		names of per packet features (see data_utils.packet_features) to compute from the
+		packets before encoding and store next to them, read back with load_features()
+	"""
+
+	arrays = {'body_parts': np.array(list(packets.keys())), 'fs': np.float64(fs)}
+	if features is not None:
+		arrays['feature_names'] = np.array(feature_names(features))
+		for i,X in enumerate(packet_features(packets, features).values()):
+			arrays[f'features_{i}'] = X
+	if codec is None:
+		for i,(arrival_times,packet_data) in enumerate(packets.values()):
+			arrays[f'arrival_times_{i}'] = np.asarray(arrival_times)
+			arrays[f'packet_data_{i}'] = np.asarray(packet_data)
+		np.savez(path, **arrays)
+	elif codec == 'int16':
+		arrays['codec'] = np.array(codec)
+		arrays['scale'] = np.float64(scale)
+		for i,(arrival_times,packet_data) in enumerate(packets.values()):
+			encoded = encode_packets(arrival_times, packet_data, scale, fs)
+			arrays[f'arrival_deltas_{i}'] = encoded['arrival_deltas']
+			arrays[f'samples_{i}'] = encoded['samples']
+		np.savez_compressed(path, **arrays)
+	else:
+		raise ValueError("codec must be None or 'int16'")
+
+
+def load_packets(path: str,dtype=np.float64) -> dict:
+	""" Loads a packet store written by save_packets(), a pickled packets dict (like
+		packets.pickle) is also accepted
+
+	Parameters
+	----------
+
+	dtype: np.dtype
+		type of the decoded packet data of an 'int16' store
+
+	Returns
+	-------
+
+	packets: dict
+		per body part a tuple (arrival_times, packet_data), same as sparsify_data
+	"""
+
+	if path.endswith('.pickle') or path.endswith('.pkl'):
+		with open(path, 'rb') as handle:
+			return pickle.load(handle)
+
+	with np.load(path) as store:
+		if 'codec' not in store:
+			return {str(bp): (store[f'arrival_times_{i}'], store[f'packet_data_{i}']) for i,bp in enumerate(store['body_parts'])}
+		return {str(bp): decode_packets({
+				'arrival_deltas': store[f'arrival_deltas_{i}'],
+				'samples': store[f'samples_{i}'],
+				'scale': float(store['scale']),
+				'fs': float(store['fs']),
+				't0': 0.0
+			}, dtype) for i,bp in enumerate(store['body_parts'])}
+
+
+def load_features(path: str):
+	""" The packet features stored by save_packets(..., features=...)
+
+	Returns
+	-------
+
+	features: dict
+		per body part a P x F feature matrix, row p belongs to packet p of load_packets()
+
+	names: list
+		the F column names
+	"""
+
+	with np.load(path) as store:
+		if 'feature_names' not in store:
+			raise ValueError(f"{path} has no packet features, save it with save_packets(..., features=...)")
+		return {str(bp): store[f'features_{i}'] for i,bp in enumerate(store['body_parts'])}, [str(name) for name in store['feature_names']]
+
+
+def encode_packets(arrival_times: np.ndarray,packet_data: np.ndarray,scale: float=DEFAULT_SCALE,fs: float=25,t0: float=0.0) -> dict:
+	""" Compact int16 encoding of the packets of one body part, vectorized over all packets
+
+	Samples are quantized to int16 steps of scale (clipped to the int16 range) and delta
+	encoded within each packet (the first sample is kept, the rest are differences to the
+	previous sample, wrapping in int16 so decoding is exact), which makes them compress well.
+	Arrival times are stored as the difference in samples to the previous arrival, which is
+	exact for a uniformly sampled stream.
+
+	Returns
+	-------
+
+	encoded: dict
+		'samples': P x packet_size x 3 int16, 'arrival_deltas': P uint32, 'scale', 'fs', 't0'
+	"""
+
+	arrival_idxs = arrival_index(arrival_times, fs, t0)
+	return {
+		'samples': quantize_deltas(packet_data, scale),
+		'arrival_deltas': np.diff(arrival_idxs, prepend=0).astype(np.uint32),
+		'scale': scale,
+		'fs': fs,
+		't0': t0
+	}
+
+
+def decode_packets(encoded: dict,dtype=np.float64):
+	""" Inverse of encode_packets(), returns (arrival_times, packet_data) """
+	arrival_idxs = np.cumsum(encoded['arrival_deltas'], dtype=np.int64)
+	arrival_times = (encoded['t0'] + arrival_idxs/encoded['fs']).astype(dtype)
+	return arrival_times, dequantize_deltas(encoded['samples'], encoded['scale'], dtype)
+
+
+def arrival_index(arrival_times: np.ndarray,fs: float=25,t0: float=0.0) -> np.ndarray:
+	""" sample index of each arrival time """
+	return np.round((np.asarray(arrival_times, dtype=np.float64).reshape(-1) - t0)*fs).astype(np.int64)
+
+
+def quantize_deltas(packet_data: np.ndarray,scale: float=DEFAULT_SCALE) -> np.ndarray:
+	""" P x packet_size x 3 data to int16 steps of scale, delta encoded along the samples """
+	q = np.clip(np.round(np.asarray(packet_data)/scale), -2**15, 2**15-1).astype(np.int16)
+	deltas = q.copy()
+	deltas[:,1:] = q[:,1:] - q[:,:-1] # wraps around in int16
+	return deltas
+
+
+def dequantize_deltas(deltas: np.ndarray,scale: float=DEFAULT_SCALE,dtype=np.float64) -> np.ndarray:
+	""" inverse of quantize_deltas() """
+	q = np.cumsum(deltas, axis=1, dtype=np.int16) # wraps back
+	return (q*scale).astype(dtype)
+
+
+def merge_packets(packets: dict):
+	""" Merges the packets of all body parts into one stream ordered by arrival time
+		(ties keep the body part order)
+
+	Returns
+	-------
+
+	arrival_times: np.ndarray
+		P arrival times in seconds
+
+	body_part_idxs: np.ndarray
+		P indices into the keys of packets
+
+	packet_data: np.ndarray
+		P x packet_size x 3
+	"""
+
+	arrival_times = np.concatenate([np.asarray(at, dtype=np.float64).reshape(-1) for at,_ in packets.values()])
+	body_part_idxs = np.concatenate([np.full(len(at), i) for i,(at,_) in enumerate(packets.values())])
+	packet_data = np.concatenate([data for _,data in packets.values()])
+	order = np.argsort(arrival_times, kind='stable')
+	return arrival_times[order], body_part_idxs[order], packet_data[order]
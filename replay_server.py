@@ -0,0 +1,228 @@
+import asyncio
+import json
+import numpy as np
+
+from packet_store import load_packets, merge_packets, arrival_index, quantize_deltas, dequantize_deltas, DEFAULT_SCALE
+
+
+def record_dtype(packet_size: int,dtype='<f4',codec: str=None) -> np.dtype:
+	""" Wire format of one packet: body part index, arrival time in seconds (of the original
+		stream) and the packet_size x 3 samples, packed little endian. With the 'int16' codec
+		the arrival is the sample index and the samples are int16 deltas (see packet_store) """
+	if codec == 'int16':
+		return np.dtype([('body_part','<u2'),('arrival_index','<u4'),('data','<i2',(packet_size,3))])
+	return np.dtype([('body_part','<u2'),('arrival_time','<f8'),('data',dtype,(packet_size,3))])
+
+
+class PacketReplayServer():
+	"""
+	asyncio server that streams packets to TCP or unix socket clients at their original
+	arrival times, as if they were arriving from the devices
+
+	usage example:
+		server = PacketReplayServer(packets, speed=10)
+		await server.start_tcp('127.0.0.1', 8765)
+		await server.serve_forever()
+
+	Every client gets its own replay, starting when it connects. A client first receives one
+	json line describing the stream ('body_parts', 'packet_size', 'dtype', 'n_packets', 'speed',
+	'codec' and its 'scale', 'fs', 't0') and then the packets as fixed size binary records, see
+	record_dtype() and read_packets().
+	Packets that are due at the same time are written in one batch. Backpressure is per client:
+	a slow client only delays its own replay, which then catches up as fast as it can.
+	"""
+
+	def __init__(self,
+				 packets: dict,
+				 speed=1.0,
+				 dtype='<f4',
+				 t0=0.0,
+				 batch_size=1024,
+				 codec=None,
+				 scale=DEFAULT_SCALE,
+				 fs=25) -> None:
+		"""
+		packets:
+			per body part a tuple (arrival_times, packet_data) as returned by sparsify_data
+			or load_packets()
+
+		speed:
+			replay speed relative to real time, None to send as fast as possible
+
+		dtype:
+			type of the samples on the wire
+
+		t0:
+			stream time (s) the replay starts at, a client waits until the first arrival
+
+		batch_size:
+			max packets per write before waiting for the client to drain
+
+		codec:
+			None to send the samples as dtype, 'int16' to send them quantized at scale and
+			delta encoded with the arrival as a sample index at fs (about half the bytes of
+			float32, a quarter of float64)
+		"""
+		self.body_parts = list(packets.keys())
+		self.speed = None if speed is None or speed == np.inf else float(speed)
+		self.t0 = t0
+		self.batch_size = batch_size
+
+		arrival_times, body_part_idxs, packet_data = merge_packets(packets)
+		self.packet_size = packet_data.shape[1]
+		self.arrival_times = arrival_times
+
+		# all packets are encoded once, a client is just an offset into the buffer
+		self.dtype = record_dtype(self.packet_size, dtype, codec)
+		records = np.zeros(len(arrival_times), dtype=self.dtype)
+		records['body_part'] = body_part_idxs
+		if codec == 'int16':
+			records['arrival_index'] = arrival_index(arrival_times, fs)
+			records['data'] = quantize_deltas(packet_data, scale)
+		else:
+			records['arrival_time'] = arrival_times
+			records['data'] = packet_data
+		self.records = memoryview(records.tobytes())
+		self.header = (json.dumps({
+			'body_parts': self.body_parts,
+			'packet_size': self.packet_size,
+			'dtype': self.dtype.descr,
+			'n_packets': len(arrival_times),
+			'speed': self.speed,
+			'codec': codec,
+			'scale': scale,
+			'fs': fs,
+			't0': 0.0
+		})+'\n').encode()
+
+		self.servers = []
+		self.clients = {} # per connection: packets sent and max lag behind schedule (s)
+
+	@classmethod
+	def from_store(cls, path: str, **kwargs):
+		""" builds the server from a packet store on disk, see packet_store.load_packets() """
+		return cls(load_packets(path), **kwargs)
+
+	async def start_tcp(self, host='127.0.0.1', port=0):
+		""" starts listening on a local tcp port (0 picks a free one), returns the asyncio server """
+		server = await asyncio.start_server(self._handle, host, port)
+		self.servers.append(server)
+		return server
+
+	async def start_unix(self, path: str):
+		""" starts listening on a unix socket, returns the asyncio server """
+		server = await asyncio.start_unix_server(self._handle, path)
+		self.servers.append(server)
+		return server
+
+	async def serve_forever(self):
+		await asyncio.gather(*[server.serve_forever() for server in self.servers])
+
+	def close(self):
+		for server in self.servers:
+			server.close()
+
+	async def _handle(self, reader, writer):
+		loop = asyncio.get_running_loop()
+		stats = {'sent': 0, 'max_lag': 0.0}
+		self.clients[id(writer)] = stats
+		R = self.dtype.itemsize
+		N = len(self.arrival_times)
+		try:
+			writer.write(self.header)
+			start = loop.time()
+			i = 0
+			while i < N:
+				if self.speed is None:
+					j = min(i+self.batch_size, N)
+				else:
+					# everything that is due by now
+					now = self.t0 + (loop.time()-start)*self.speed
+					j = int(np.searchsorted(self.arrival_times, now, side='right'))
+					if j == i:
+						await asyncio.sleep((self.arrival_times[i]-now)/self.speed)
+						continue
+					j = min(j, i+self.batch_size)
+					stats['max_lag'] = max(stats['max_lag'], (now-self.arrival_times[i])/self.speed)
+
+				writer.write(self.records[i*R:j*R])
+				stats['sent'] += j-i
+				i = j
+				await writer.drain()
+			writer.write_eof()
+			await writer.drain()
+		except ConnectionError:
+			pass
+		finally:
+			del self.clients[id(writer)]
+			writer.close()
+
+
+async def read_packets(reader):
+	""" Client side of PacketReplayServer, an async generator over the received packets
+
+	usage example:
+		reader, writer = await asyncio.open_connection('127.0.0.1', 8765)
+		async for header, records in read_packets(reader):
+			records['arrival_time'], records['body_part'], records['data']
+
+	Yields
+	------
+
+	header: dict
+		the json header sent by the server
+
+	records: np.ndarray
+		a batch of packets as a structured array with fields body_part (index into
+		header['body_parts']), arrival_time and data (packet_size x 3), packets sent with
+		the 'int16' codec are decoded to float32 data
+	"""
+
+	header = json.loads(await reader.readline())
+	dtype = np.dtype([(name,t,*[tuple(s) for s in shape]) for name,t,*shape in header['dtype']])
+	R = dtype.itemsize
+	buf = bytearray()
+	while True:
+		chunk = await reader.read(max(R, 1<<16))
+		if not chunk:
+			break
+		buf += chunk
+		n = len(buf)//R
+		if n > 0:
+			records = np.frombuffer(bytes(buf[:n*R]), dtype=dtype)
+			del buf[:n*R]
+			if header.get('codec') == 'int16':
+				records = _decode_records(records, header)
+			yield header, records
+
+
+def _decode_records(records, header):
+	decoded = np.zeros(len(records), dtype=record_dtype(header['packet_size']))
+	decoded['body_part'] = records['body_part']
+	decoded['arrival_time'] = header['t0'] + records['arrival_index']/header['fs']
+	decoded['data'] = dequantize_deltas(records['data'], header['scale'], np.float32)
+	return decoded
+
+
+async def _main(path, speed, port, unix, codec):
+	server = PacketReplayServer.from_store(path, speed=speed, codec=codec)
+	if unix is not None:
+		await server.start_unix(unix)
+		print(f"replaying {len(server.arrival_times)} packets on {unix}")
+	else:
+		s = await server.start_tcp('127.0.0.1', port)
+		print(f"replaying {len(server.arrival_times)} packets on 127.0.0.1:{s.sockets[0].getsockname()[1]}")
+	await server.serve_forever()
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description="replays a packet store to local clients")
+	parser.add_argument('path', nargs='?', default='packets.pickle', help="packet store (.npz) or pickled packets")
+	parser.add_argument('--speed', type=float, default=1.0, help="replay speed, 0 for as fast as possible")
+	parser.add_argument('--port', type=int, default=8765)
+	parser.add_argument('--unix', default=None, help="unix socket path instead of tcp")
+	parser.add_argument('--codec', default=None, choices=['int16'], help="compact int16 packet encoding")
+	args = parser.parse_args()
+	asyncio.run(_main(args.path, args.speed if args.speed > 0 else None, args.port, args.unix, args.codec))
@@ -0,0 +1,150 @@
+import os
+import numpy as np
+
+G = 9.81 # m/s^2
+
+# synthetic motion per activity (label ids as in the label_map of iotdi_demo.py):
+# name, step/cycle frequency (Hz), motion amplitude (m/s^2), noise std (m/s^2), lying down
+ACTIVITY_PROFILES = {
+	0: ('sitting', 0.0, 0.0, 0.05, False),
+	1: ('standing', 0.0, 0.0, 0.08, False),
+	2: ('lying, back', 0.0, 0.0, 0.03, True),
+	4: ('ascending stairs', 1.6, 3.0, 0.4, False),
+	8: ('walking, parking lot', 1.8, 3.5, 0.4, False),
+	9: ('walking, flat treadmill', 1.9, 4.0, 0.3, False),
+	11: ('running, treadmill', 2.7, 12.0, 1.0, False),
+	12: ('exercising, stepper', 1.5, 3.0, 0.3, False),
+	14: ('exercise bike horizontal', 1.2, 2.0, 0.3, False),
+	17: ('jumping', 2.0, 15.0, 1.5, False),
+}
+
+
+def generate_stream(directory: str,name: str,duration: float,n_body_parts: int=5,fs: float=25,activities: dict=None,
+					segment_seconds=(30,300),seed: int=0,time_column: bool=False,chunk_seconds: float=3600,dtype=np.float64):
+	""" Writes a synthetic label and accelerometer stream to {directory}/{name}_labels.npy and
+		{directory}/{name}_data.npy in the layout of data_streams/, chunk by chunk into memory
+		mapped files so streams larger than RAM can be made
+
+	The stream is a sequence of activity segments. Within a segment every body part sees
+	gravity at a fixed orientation (on its side when lying down) plus a periodic motion at
+	the cadence of the activity with its first two harmonics and sensor noise. Amplitude,
+	cadence and orientation vary per segment and body part. The same seed gives the same
+	stream, independent of chunk_seconds.
+
+	Parameters
+	----------
+
+	duration: float
+		length of the stream in seconds
+
+	n_body_parts: int
+		number of 3-axis accelerometers K
+
+	fs: float
+		sampling rate in Hz
+
+	activities: dict
+		activity mix, label -> relative weight of the labels in ACTIVITY_PROFILES. Defaults
+		to all activities with equal weight
+
+	segment_seconds: tuple
+		(min, max) length of an activity segment in seconds, drawn uniformly
+
+	time_column: bool
+		whether the data gets the time in seconds as an extra first row, (3K+1) x T like the
+		data windows of sparsify_data (transposed), instead of 3K x T
+
+	chunk_seconds: float
+		seconds of data generated and written at a time
+
+	Returns
+	-------
+
+	labels: np.memmap
+		T labels, opened read only
+
+	data: np.memmap
+		3K x T (or (3K+1) x T) accelerations in m/s^2, opened read only
+	"""
+
+	from numpy.lib.format import open_memmap
+
+	if activities is None:
+		activities = {label: 1.0 for label in ACTIVITY_PROFILES}
+	labels_mix = np.array(list(activities.keys()))
+	weights = np.array(list(activities.values()), dtype=np.float64)
+	if not set(labels_mix.tolist()) <= set(ACTIVITY_PROFILES):
+		raise ValueError(f"activities must be labels of ACTIVITY_PROFILES: {list(ACTIVITY_PROFILES)}")
+
+	T = int(round(duration*fs))
+	K = n_body_parts
+	segment_seq, noise_seq = np.random.SeedSequence(seed).spawn(2)
+	rng = np.random.default_rng(segment_seq)
+	noise_rng = np.random.default_rng(noise_seq)
+
+	# segments are small, draw them all up front
+	starts = [0]
+	while starts[-1] < T:
+		starts.append(starts[-1] + max(1, int(rng.uniform(*segment_seconds)*fs)))
+	starts = np.array(starts[:-1])
+	S = len(starts)
+	seg_labels = rng.choice(labels_mix, size=S, p=weights/weights.sum())
+	profiles = np.array([ACTIVITY_PROFILES[label][1:] for label in seg_labels], dtype=np.float64) # S x 4
+	cadence = profiles[:,0,None]*rng.uniform(0.9, 1.1, (S,1))
+	amplitude = profiles[:,1,None]*rng.uniform(0.5, 1.5, (S,K))
+	noise = profiles[:,2,None]*np.ones((S,K))
+	# gravity direction per segment and body part, mostly along z (x when lying down)
+	up = np.where(profiles[:,3,None,None] > 0, [1.0,0.0,0.0], [0.0,0.0,1.0]) # S x 1 x 3
+	gravity = up + rng.normal(0, 0.2, (S,K,3))
+	gravity *= G/np.linalg.norm(gravity, axis=2, keepdims=True)
+	axis_weights = rng.uniform(0.2, 1.0, (S,K,3)) # how much of the motion each axis sees
+	harmonic = rng.uniform(0.2, 0.5, (S,K)) # 2nd harmonic relative to the 1st
+	phase = rng.uniform(0, 2*np.pi, (S,K,3))
+
+	os.makedirs(directory, exist_ok=True)
+	rows = 3*K+1 if time_column else 3*K
+	labels = open_memmap(os.path.join(directory, f'{name}_labels.npy'), mode='w+', dtype=np.int64, shape=(T,))
+	data = open_memmap(os.path.join(directory, f'{name}_data.npy'), mode='w+', dtype=dtype, shape=(rows,T))
+
+	chunk = max(1, int(chunk_seconds*fs))
+	for start in range(0, T, chunk):
+		k = np.arange(start, min(start+chunk, T))
+		t = k/fs
+		s = np.searchsorted(starts, k, side='right')-1 # segment of each sample
+		labels[start:start+len(k)] = seg_labels[s]
+
+		# T' x K x 3
+		w = 2*np.pi*cadence[s][:,:,None]*t[:,None,None]
+		motion = np.sin(w+phase[s]) + harmonic[s][:,:,None]*np.sin(2*w+2*phase[s])
+		acc = gravity[s] + amplitude[s][:,:,None]*axis_weights[s]*motion
+		acc += noise[s][:,:,None]*noise_rng.standard_normal((len(k),K,3))
+
+		out = acc.reshape(len(k), 3*K).T # armX | armY | armZ | legX | ...
+		if time_column:
+			data[0,start:start+len(k)] = t
+			data[1:,start:start+len(k)] = out
+		else:
+			data[:,start:start+len(k)] = out
+	labels.flush()
+	data.flush()
+	del labels, data
+
+	return (np.load(os.path.join(directory, f'{name}_labels.npy'), mmap_mode='r'),
+			np.load(os.path.join(directory, f'{name}_data.npy'), mmap_mode='r'))
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description="writes a synthetic stream next to the bundled ones")
+	parser.add_argument('name', help="stream name, e.g. synthetic_8h")
+	parser.add_argument('--hours', type=float, default=1.0)
+	parser.add_argument('--body-parts', type=int, default=5)
+	parser.add_argument('--fs', type=float, default=25)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--dir', default='data_streams')
+	parser.add_argument('--activities', type=int, nargs='*', default=None, help="labels to mix with equal weight")
+	args = parser.parse_args()
+	activities = None if args.activities is None else {label: 1.0 for label in args.activities}
+	labels, data = generate_stream(args.dir, args.name, args.hours*3600, args.body_parts, args.fs, activities, seed=args.seed)
+	print(f"wrote {args.dir}/{args.name}_labels.npy {labels.shape} and {args.dir}/{args.name}_data.npy {data.shape}")
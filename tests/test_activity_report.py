@@ -0,0 +1,25 @@
+""" The energy columns of activity_report add up to the energy accounting of sparsify_data """
+import numpy as np
+import pytest
+
+from energy_harvest import EnergyHarvester
+from data_utils import sparsify_data, activity_report
+from test_policy_regression import make_data_window, eh_params, BODY_PARTS, POLICIES, PACKET_SIZE, LEAKAGE
+
+
+@pytest.mark.parametrize('policy', POLICIES)
+def test_surplus_adds_up(policy):
+	data_window = make_data_window()
+	# activities switch every 20 s like the motion of make_data_window
+	labels = (np.arange(len(data_window))//(25*20)) % 3
+	result = sparsify_data(data_window, BODY_PARTS, PACKET_SIZE, LEAKAGE, EnergyHarvester(**eh_params), policy,
+						   return_valid=True, return_accounting=True, return_trace=True)
+	report = activity_report(labels, result.valid, traces=result.traces)
+	for bp in BODY_PARTS:
+		rows = report[report['body_part'] == bp]
+		a = result.accounting[bp]
+		# plus the surplus the dense policy drops, logged as corrections of its packets
+		spent = a['overhead'] + a['packets'] + a['leakage'] + result.traces[bp].log['correction'].sum()
+		assert rows['packets'].sum() == len(result.packets[bp][0])
+		assert rows['spent'].sum() == pytest.approx(spent, rel=1e-9)
+		assert rows['energy_surplus'].sum() == pytest.approx(a['harvested'] - spent, rel=1e-9, abs=1e-12)
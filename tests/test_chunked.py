@@ -0,0 +1,50 @@
+""" The chunked sparsify gives the packets of sparsify_data over the whole stream, for any
+chunk length and with the state passed through json between chunks """
+import json
+import numpy as np
+import pytest
+
+from energy_harvest import EnergyHarvester
+from data_utils import sparsify, sparsify_data, PolicyState
+from test_policy_regression import make_data_window, eh_params, BODY_PARTS, POLICIES, PACKET_SIZE, LEAKAGE
+
+
+def run_chunked(data_window, eh, policy, chunk, fs=None, through_json=False):
+	state = None
+	packets = {bp: [] for bp in BODY_PARTS}
+	for start in range(0, len(data_window), chunk):
+		if through_json and state is not None:
+			state = {bp: PolicyState.from_dict(json.loads(json.dumps(s.to_dict()))) for bp,s in state.items()}
+		chunk_packets, state = sparsify(data_window[start:start+chunk], BODY_PARTS, PACKET_SIZE, LEAKAGE, eh, policy, state,
+										fs=fs, final=start+chunk >= len(data_window))
+		for bp in BODY_PARTS:
+			packets[bp].append(chunk_packets[bp])
+	return {bp: (np.concatenate([p[0] for p in packets[bp]]), np.concatenate([p[1] for p in packets[bp]])) for bp in BODY_PARTS}, state
+
+
+def assert_same_packets(packets, ref):
+	for bp in BODY_PARTS:
+		np.testing.assert_array_equal(packets[bp][0], ref[bp][0])
+		np.testing.assert_array_equal(packets[bp][1], ref[bp][1])
+
+
+@pytest.mark.parametrize('policy', POLICIES)
+@pytest.mark.parametrize('chunk', [333, 4000])
+def test_matches_sparsify_data(policy, chunk):
+	data_window = make_data_window(seconds=600)
+	eh = EnergyHarvester(**eh_params)
+	ref = sparsify_data(data_window, BODY_PARTS, PACKET_SIZE, LEAKAGE, eh, policy, return_accounting=True)
+	packets, state = run_chunked(data_window, eh, policy, chunk)
+	assert_same_packets(packets, ref.packets)
+	for bp in BODY_PARTS:
+		assert state[bp].k == len(data_window)
+		assert state[bp].accounting()['harvested'] == pytest.approx(ref.accounting[bp]['harvested'], rel=1e-12)
+
+
+def test_matches_sparsify_data_fft_without_time():
+	# the fft engine holds back whole blocks, the state goes through json in between
+	data_window = make_data_window(seconds=600)[:,1:]
+	eh = EnergyHarvester(**eh_params, engine='fft')
+	ref = sparsify_data(data_window, BODY_PARTS, PACKET_SIZE, LEAKAGE, eh, fs=25)
+	packets, _ = run_chunked(data_window, eh, 'opportunistic', 2500, fs=25, through_json=True)
+	assert_same_packets(packets, ref)
@@ -0,0 +1,38 @@
+""" EnergyTrace rebuilds the e_plot array it replaces and indexes like it """
+import numpy as np
+import pytest
+
+from energy_harvest import EnergyHarvester
+from data_utils import sparsify_data
+from test_policy_regression import make_data_window, eh_params, BODY_PARTS, POLICIES, PACKET_SIZE, LEAKAGE
+
+
+def run(policy='opportunistic'):
+	result = sparsify_data(make_data_window(), BODY_PARTS, PACKET_SIZE, LEAKAGE, EnergyHarvester(**eh_params), policy,
+						   visualize=True, return_trace=True)
+	return result.e_plots, result.traces
+
+
+def test_int_index():
+	e_plots, traces = run()
+	trace, e_plot = traces['arm'], e_plots['arm']
+	n = len(trace)
+	for k in [0, 1, n//2, n-1, -1, -2, -n]:
+		assert trace[k] == pytest.approx(e_plot[k], rel=0, abs=1e-12)
+	assert trace[np.int64(-1)] == trace[n-1]
+	for k in [n, -n-1]:
+		with pytest.raises(IndexError):
+			trace[k]
+
+
+@pytest.mark.parametrize('policy', POLICIES)
+def test_matches_e_plots(policy):
+	e_plots, traces = run(policy)
+	for bp in BODY_PARTS:
+		trace, e_plot = traces[bp], e_plots[bp]
+		n = len(trace)
+		assert n == len(e_plot)
+		np.testing.assert_allclose(trace[:], e_plot, rtol=0, atol=1e-12)
+		for start, end in [(0, 1), (37, 1000), (n-500, n), (n-10, n+10)]:
+			np.testing.assert_allclose(trace.window(start, end), e_plot[start:end], rtol=0, atol=1e-12)
+		np.testing.assert_allclose(trace[10:n:7], e_plot[10:n:7], rtol=0, atol=1e-12)
@@ -0,0 +1,34 @@
+""" FleetSimulator runs the same policy as sparsify_data, device by device """
+import numpy as np
+import pytest
+
+from energy_harvest import EnergyHarvester
+from data_utils import sparsify_data
+from fleet_sim import FleetSimulator
+from test_policy_regression import make_data_window, eh_params, BODY_PARTS, POLICIES, PACKET_SIZE, LEAKAGE
+
+
+@pytest.mark.parametrize('policy', POLICIES)
+def test_matches_sparsify_data(policy):
+	# two windows with different activity levels, device d is body part d % K of window d // K
+	data_window = make_data_window()
+	quieter = data_window.copy()
+	quieter[:,1:] *= 0.7
+	data_windows = [data_window, quieter]
+	eh = EnergyHarvester(**eh_params)
+
+	fleet = FleetSimulator.from_data_windows(data_windows, BODY_PARTS, PACKET_SIZE, LEAKAGE, eh, policy)
+	packets = fleet.run()
+	acc = np.stack([w[:,3*i+1:3*i+4] for w in data_windows for i in range(len(BODY_PARTS))])
+	packet_data = fleet.packet_data(acc)
+	accounting = fleet.accounting()
+
+	for w, window in enumerate(data_windows):
+		ref = sparsify_data(window, BODY_PARTS, PACKET_SIZE, LEAKAGE, eh, policy, return_accounting=True)
+		for i, bp in enumerate(BODY_PARTS):
+			d = w*len(BODY_PARTS) + i
+			sent = packets['device'] == d
+			np.testing.assert_array_equal(packets['arrival_time'][sent], np.asarray(ref.packets[bp][0]).reshape(-1))
+			np.testing.assert_array_equal(packet_data[sent], ref.packets[bp][1])
+			assert accounting['n_packets'][d] == ref.accounting[bp]['n_packets']
+			assert accounting['leakage'][d] == pytest.approx(ref.accounting[bp]['leakage'], rel=1e-12)
@@ -0,0 +1,36 @@
+""" The int16 codec of the packet store round-trips the packets of sparsify_data """
+import numpy as np
+
+from energy_harvest import EnergyHarvester
+from data_utils import sparsify_data
+from packet_store import save_packets, load_packets, encode_packets, decode_packets, DEFAULT_SCALE
+from test_policy_regression import make_data_window, eh_params, BODY_PARTS, PACKET_SIZE, LEAKAGE
+
+
+def make_packets():
+	return sparsify_data(make_data_window(), BODY_PARTS, PACKET_SIZE, LEAKAGE, EnergyHarvester(**eh_params), 'dense')
+
+
+def test_int16_round_trip(tmp_path):
+	packets = make_packets()
+	path = str(tmp_path / 'packets.npz')
+	save_packets(path, packets, fs=25, codec='int16')
+	loaded = load_packets(path)
+	assert list(loaded.keys()) == BODY_PARTS
+	for bp in BODY_PARTS:
+		arrival_times, packet_data = packets[bp]
+		np.testing.assert_allclose(loaded[bp][0], np.asarray(arrival_times).reshape(-1), rtol=0, atol=1e-9)
+		# quantized to the nearest step, the deltas add up without drift along a packet
+		np.testing.assert_allclose(loaded[bp][1], packet_data, rtol=0, atol=DEFAULT_SCALE/2 + 1e-12)
+
+
+def test_int16_exact_on_the_grid():
+	# data that already lies on the int16 grid decodes exactly, including deltas that wrap
+	packets = make_packets()
+	arrival_times, packet_data = packets['arm']
+	packet_data = np.round(packet_data/DEFAULT_SCALE)*DEFAULT_SCALE
+	packet_data[0,::2] = 2**15*DEFAULT_SCALE - DEFAULT_SCALE
+	packet_data[0,1::2] = -2**15*DEFAULT_SCALE
+	decoded_times, decoded_data = decode_packets(encode_packets(arrival_times, packet_data))
+	np.testing.assert_allclose(decoded_times, np.asarray(arrival_times).reshape(-1), rtol=0, atol=1e-9)
+	np.testing.assert_array_equal(decoded_data, packet_data)
@@ -0,0 +1,72 @@
+""" Pins the packet decisions and stored energy of sparsify_data to the output of the original
+per sample policy loop, so changes to _run_policy cannot silently change them.
+
+The fixture was made with the baseline implementation, only regenerate it (python
+tests/test_policy_regression.py) when a change of the packet decisions is intended """
+import os
+import numpy as np
+import pytest
+
+from energy_harvest import EnergyHarvester
+from data_utils import sparsify_data
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'policy_regression.npz')
+BODY_PARTS = ['arm','leg']
+POLICIES = ['opportunistic','dense','conservative_1.2']
+PACKET_SIZE = 16
+LEAKAGE = 6e-6
+
+eh_params = {
+	'proof_mass': 1*(10**-3),
+	'spring_const': 0.17,
+	'spring_damp': 0.0055,
+	'disp_max': 0.01,
+	'efficiency':0.3
+}
+
+
+def make_data_window(fs=25, seconds=240):
+	""" deterministic (3K+1) x T window without random numbers: rest, walking and running
+		like bursts of a few harmonics on top of gravity """
+	t = np.arange(int(fs*seconds))/fs
+	# activity level switches every 20 s between rest, walking and running
+	level = np.array([0.0, 3.0, 0.3, 10.0, 1.5, 6.0])[(t//20).astype(int) % 6]
+	columns = [t]
+	for i in range(len(BODY_PARTS)):
+		for axis in range(3):
+			f = 1.7 + 0.2*i + 0.05*axis
+			motion = np.sin(2*np.pi*f*t + axis) + 0.4*np.sin(4*np.pi*f*t + 0.5*i) + 0.1*np.sin(2*np.pi*7.3*t*(axis+1))
+			columns.append((9.81 if axis == 2 else 0.0) + level*motion)
+	return np.stack(columns, axis=1)
+
+
+def run(policy):
+	packets, e_plots, thresh = sparsify_data(make_data_window(), BODY_PARTS, PACKET_SIZE, LEAKAGE, EnergyHarvester(**eh_params), policy, visualize=True)
+	return packets, e_plots
+
+
+@pytest.mark.parametrize('policy', POLICIES)
+def test_matches_baseline(policy):
+	packets, e_plots = run(policy)
+	data_window = make_data_window()
+	with np.load(FIXTURE) as fixture:
+		for i,bp in enumerate(BODY_PARTS):
+			arrival_times, packet_data = packets[bp]
+			np.testing.assert_array_equal(np.asarray(arrival_times).reshape(-1), fixture[f'{policy}_{bp}_arrival_times'])
+			np.testing.assert_allclose(e_plots[bp], fixture[f'{policy}_{bp}_e_plot'], rtol=0, atol=1e-12)
+
+			# a packet is the packet_size samples before its arrival
+			ends = np.searchsorted(data_window[:,0], fixture[f'{policy}_{bp}_arrival_times'])
+			sample_idxs = ends[:,None] - PACKET_SIZE + np.arange(PACKET_SIZE)
+			np.testing.assert_array_equal(packet_data, data_window[sample_idxs][:,:,3*i+1:3*i+4])
+
+
+if __name__ == '__main__':
+	arrays = {}
+	for policy in POLICIES:
+		packets, e_plots = run(policy)
+		for bp in BODY_PARTS:
+			arrays[f'{policy}_{bp}_arrival_times'] = np.asarray(packets[bp][0], dtype=np.float64).reshape(-1)
+			arrays[f'{policy}_{bp}_e_plot'] = np.asarray(e_plots[bp], dtype=np.float64)
+			print(policy, bp, len(arrays[f'{policy}_{bp}_arrival_times']), "packets")
+	np.savez_compressed(FIXTURE, **arrays)
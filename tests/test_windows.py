@@ -0,0 +1,76 @@
+""" assemble_windows matches a plain per window loop and iter_windows streams the same windows
+from chunked sparsify """
+import bisect
+import numpy as np
+import pytest
+
+from energy_harvest import EnergyHarvester
+from data_utils import sparsify, sparsify_data, assemble_windows, iter_windows
+from test_policy_regression import make_data_window, eh_params, BODY_PARTS, PACKET_SIZE, LEAKAGE
+
+FS = 25
+SETTINGS = [(50, None, 'hold'), (50, 7, 'zero'), (250, 13, 'hold')]
+
+
+def naive_windows(packets, length, window, stride, imputation):
+	""" one window and one sample at a time, only from the packets that arrived by the window end """
+	stride = window if stride is None else stride
+	windows, masks, staleness = [], [], []
+	for end in range(window, length+1, stride):
+		w = np.zeros((window, 3*len(BODY_PARTS)))
+		m = np.zeros((window, len(BODY_PARTS)), dtype=bool)
+		s = np.full(len(BODY_PARTS), np.inf)
+		for i, bp in enumerate(BODY_PARTS):
+			arrival_times, packet_data = packets[bp]
+			received = {}
+			for at, data in zip(np.asarray(arrival_times).reshape(-1), packet_data):
+				arrival = int(round(at*FS))
+				if arrival <= end:
+					received.update({arrival - PACKET_SIZE + j: data[j] for j in range(PACKET_SIZE)})
+					s[i] = (end - arrival)/FS
+			received_idxs = sorted(received)
+			for j, k in enumerate(range(end-window, end)):
+				m[j,i] = k in received
+				held = bisect.bisect_right(received_idxs, k)
+				if m[j,i] or (imputation == 'hold' and held > 0):
+					w[j,3*i:3*i+3] = received[received_idxs[held-1]]
+		windows.append(w)
+		masks.append(m)
+		staleness.append(s)
+	return np.array(windows), np.array(masks), np.array(staleness)
+
+
+@pytest.fixture(scope='module')
+def stream():
+	data_window = make_data_window()
+	eh = EnergyHarvester(**eh_params)
+	return data_window, eh, sparsify_data(data_window, BODY_PARTS, PACKET_SIZE, LEAKAGE, eh, 'dense')
+
+
+@pytest.mark.parametrize('window, stride, imputation', SETTINGS)
+def test_matches_naive_loop(stream, window, stride, imputation):
+	data_window, _, packets = stream
+	windows, mask, staleness, window_times = assemble_windows(packets, BODY_PARTS, len(data_window), window, stride, imputation, FS)
+	ref_windows, ref_mask, ref_staleness = naive_windows(packets, len(data_window), window, stride, imputation)
+	np.testing.assert_array_equal(windows, ref_windows)
+	np.testing.assert_array_equal(mask, ref_mask)
+	np.testing.assert_allclose(staleness, ref_staleness, rtol=0, atol=1e-12)
+	np.testing.assert_allclose(window_times, np.arange(window, len(data_window)+1, stride or window)/FS)
+
+
+@pytest.mark.parametrize('window, stride, imputation', SETTINGS)
+@pytest.mark.parametrize('chunk', [777, 5000])
+def test_iter_windows_streams_assemble_windows(stream, window, stride, imputation, chunk):
+	data_window, eh, packets = stream
+	T = len(data_window)
+
+	def chunks():
+		state = None
+		for start in range(0, T, chunk):
+			chunk_packets, state = sparsify(data_window[start:start+chunk], BODY_PARTS, PACKET_SIZE, LEAKAGE, eh, 'dense', state,
+											final=start+chunk >= T)
+			yield chunk_packets, state[BODY_PARTS[0]].k
+
+	batches = list(iter_windows(chunks(), BODY_PARTS, window, stride, imputation, FS, batch_size=37))
+	for streamed, full in zip(zip(*batches), assemble_windows(packets, BODY_PARTS, T, window, stride, imputation, FS)):
+		np.testing.assert_array_equal(np.concatenate(streamed), full)